@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+""" Rough timings for the tree code, run as python bench.py [name ...] to pick benchmarks."""
+from pathlib import Path
+import sys
+import gc
+import json
+import time
+import tracemalloc
+sys.path.append(str(Path('./src').resolve()))
+
+from roam2doc.parse import DocParser
+from roam2doc.tree import Root, List, subtree_nodes
+
+
+def nested_list_doc(depth, lists):
+    lines = []
+    for section in range(lists):
+        lines.append(f'* Section {section}')
+        lines.append('')
+        for level in range(depth):
+            indent = '  ' * level
+            lines.append(f'{indent}- item at depth {level} with *bold* and /italic/ text')
+        lines.append('')
+    return '\n'.join(lines)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - start
+
+def parse(text):
+    parser = DocParser(text, "bench.org")
+    parser.parse()
+    return parser
+
+def walk_to_root(node):
+    # what every find_root call used to do
+    parent = node.parent
+    while not isinstance(parent, Root):
+        parent = parent.parent
+    return parent
+
+def bench_deep_lists(depth=200, lists=20):
+    """ Deeply nested lists, where walking up the parent chain for the root or branch
+    costs the most."""
+    text = nested_list_doc(depth, lists)
+    parser, parse_time = timed(parse, text)
+    root = parser.root
+    html, html_time = timed(root.to_html)
+    latex, latex_time = timed(root.to_latex)
+    nodes = subtree_nodes(parser.branch)[1:]
+    start = time.perf_counter()
+    for node in nodes:
+        walk_to_root(node)
+    walk_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for node in nodes:
+        node.root
+    cached_time = time.perf_counter() - start
+    print(f"deep lists, depth {depth}, {lists} lists, {len(nodes)} nodes")
+    print(f"  parse {parse_time:.3f}s, to_html {html_time:.3f}s, to_latex {latex_time:.3f}s")
+    print(f"  one root lookup per node: parent walk {walk_time:.4f}s, cached {cached_time:.4f}s")
+
+def table_doc(rows, columns):
+    lines = ['* Table', '']
+    for row in range(rows):
+        cells = [f" *r{row}* c{col} /x/ " for col in range(columns)]
+        lines.append('|' + '|'.join(cells) + '|')
+    lines.append('')
+    return '\n'.join(lines)
+
+def bench_big_table(rows=2000, columns=8):
+    """ One big table, the cell contents are made in the table and then moved to
+    their cells, so it depends on removing children being cheap."""
+    text = table_doc(rows, columns)
+    parser, parse_time = timed(parse, text)
+    html, html_time = timed(parser.root.to_html)
+    nodes = subtree_nodes(parser.branch)
+    print(f"big table, {rows} rows of {columns} cells, {len(nodes)} nodes")
+    print(f"  parse {parse_time:.3f}s, to_html {html_time:.3f}s")
+
+def mixed_doc(sections):
+    lines = []
+    for section in range(sections):
+        lines.append(f'* Section {section}')
+        lines.append(f'<<target{section}>> A paragraph with *bold*, /italic/ and a [[target{section}][link]].')
+        lines.append('')
+        lines.append('- a list item')
+        lines.append('  - a nested item with =verbatim=')
+        lines.append('')
+        lines.append('| a | b |')
+        lines.append('| c | d |')
+        lines.append('')
+    return '\n'.join(lines)
+
+def bench_memory(sections=2000):
+    """ Memory held by the parsed tree, per node."""
+    text = mixed_doc(sections)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    parser = parse(text)
+    # only count what the tree keeps, not parse time garbage
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = subtree_nodes(parser.branch)
+    print(f"memory, {sections} sections, {len(nodes)} nodes")
+    print(f"  {after - before} bytes held after parse, {(after - before) / len(nodes):.0f} bytes per node")
+    # the node id index is part of that, the class index is only built by get_nodes
+    index_size = sys.getsizeof(parser.root.nodes_by_id)
+    print(f"  node id index {index_size / len(nodes):.0f} bytes per node of that")
+
+def prose_doc(sections, paragraphs=4, lines=6):
+    doc = []
+    for section in range(sections):
+        doc.append(f'* Section {section}')
+        for para in range(paragraphs):
+            for line in range(lines):
+                doc.append(f'Line {line} of paragraph {para}, plain prose that wraps at the fill column.')
+            doc.extend(['', '', ''])
+    return '\n'.join(doc)
+
+def bench_coalesce(sections=500):
+    """ Prose with blank line runs, before and after Root.coalesce."""
+    parser = parse(prose_doc(sections))
+    root = parser.root
+    before = len(subtree_nodes(parser.branch))
+    html_before = len(root.to_html())
+    json_before = len(json.dumps(root.to_json_dict()))
+    removed, coalesce_time = timed(root.coalesce)
+    after = len(subtree_nodes(parser.branch))
+    html, html_time = timed(root.to_html)
+    json_after = len(json.dumps(root.to_json_dict()))
+    print(f"coalesce, {sections} sections of prose, took {coalesce_time:.3f}s")
+    print(f"  nodes {before} -> {after}, html {html_before} -> {len(html)} bytes, json {json_before} -> {json_after} bytes")
+
+def outline_doc(sections, lists=20):
+    doc = []
+    for section in range(sections):
+        doc.append('*' * (section % 3 + 1) + f' Section {section}')
+        for number in range(lists):
+            # two blank lines end a list
+            doc.extend([f'- list {number}', '', ''])
+    return '\n'.join(doc)
+
+def bench_outline(sections=3000):
+    """ Many sections with many lists, where finding parent sections and list numbers
+    for the latex labels used to scan the sections or the lists before them."""
+    parser = parse(outline_doc(sections))
+    branch = parser.branch
+    parents, parent_time = timed(lambda: [branch.get_parent_section(s) for s in branch.children])
+    labels, label_time = timed(lambda: [n.get_latex_label_text() for n in parser.root.get_nodes(List)])
+    print(f"outline, {sections} sections")
+    print(f"  parent of every section {parent_time:.3f}s, label of every list {label_time:.3f}s")
+
+
+benchmarks = dict(deep_lists=bench_deep_lists, big_table=bench_big_table, memory=bench_memory,
+                  coalesce=bench_coalesce, outline=bench_outline)
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
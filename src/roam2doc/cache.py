@@ -0,0 +1,257 @@
+import os
+import io
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+import roam2doc
+from roam2doc.tree import Root, Branch, Heading, subtree_nodes
+from roam2doc.document import IncludedDocument
+from roam2doc.images import link_file_type, find_link_paths
+logger = logging.getLogger('roam2doc.cache')
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME', None)
+    if base is None:
+        base = Path(Path.home(), ".cache")
+    return Path(base, "roam2doc")
+
+def code_fingerprint():
+    """ The cache key includes the roam2doc version, but during development the version
+    does not change every time the parser does, so the source of the modules that
+    build the tree or feed it is hashed in as well."""
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        digest = hashlib.sha256(roam2doc.__version__.encode('utf-8'))
+        for name in ("parse.py", "tree.py", "images.py", "document.py", "io.py"):
+            with open(Path(Path(__file__).parent, name), "rb") as f:
+                digest.update(f.read())
+        _code_fingerprint = digest.hexdigest()
+    return _code_fingerprint
+
+_code_fingerprint = None
+
+
+class _BranchPickler(pickle.Pickler):
+    """ Pickles a branch without the rest of the tree. The root and the trunk branch
+    (when it is not the branch being pickled) are replaced with placeholders that
+    are filled in with the current run's objects on load."""
+
+    def __init__(self, file, branch):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.branch = branch
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Root) and obj is self.branch.root:
+            return "root"
+        if isinstance(obj, Branch) and obj is not self.branch and obj is self.branch.root.trunk:
+            return "trunk"
+        return None
+
+class _BranchUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, root):
+        super().__init__(file)
+        self.root = root
+
+    def persistent_load(self, pid):
+        if pid == "root":
+            return self.root
+        if pid == "trunk":
+            return self.root.trunk
+        raise pickle.UnpicklingError(f"unknown persistent id {pid}")
+
+
+class ParseCache:
+    """ An on disk cache of parsed branches, one file per parsed org file, keyed by
+    a hash of the include expanded contents together with everything else that
+    changes the parse result. When the total size of the cache files goes over
+    max_bytes the least recently used ones are removed, a hit counts as a use.
+    The size is checked by evict, which the caller runs once after a batch of
+    writes rather than on each one.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=256 * 1024 * 1024):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, contents, source, root_source):
+        digest = hashlib.sha256(code_fingerprint().encode('utf-8'))
+        # The image detection in the parser resolves link paths relative to the
+        # root source, which is relative to the working directory
+        for part in (source, root_source, os.getcwd()):
+            digest.update(b'\0')
+            digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+        if isinstance(contents, str):
+            digest.update(contents.encode('utf-8'))
+            lines = contents.split('\n')
+        else:
+            # a sequence of lines, hashed the same as the joined string
+            # without having to build it
+            for index, line in enumerate(contents):
+                if index > 0:
+                    digest.update(b'\n')
+                digest.update(line.encode('utf-8'))
+            lines = contents
+        if isinstance(contents, IncludedDocument):
+            # the nodes record the file and line each one came from, so the
+            # same text pulled in from another file is a different parse
+            for path, buffer, start, count, level, origin_line in contents.pieces:
+                digest.update(b'\0')
+                digest.update(f"{path}\0{origin_line}\0{count}\0{level}".encode('utf-8'))
+        # whether a link becomes an Image or an InternalLink depends on the
+        # linked file, which can come and go without the org file changing.
+        # The types are normally already there from prefetch_link_files.
+        for path in sorted(find_link_paths(lines, root_source)):
+            digest.update(b'\0')
+            digest.update(f"{path}\0{link_file_type(path)}".encode('utf-8'))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return Path(self.cache_dir, f"{key}.pickle")
+
+    def load(self, key, root):
+        """ Returns the DocParser for a cached parse, with its branch attached to the
+        tree under root, or None on a miss. If root is None the cached branch becomes the
+        trunk of a new Root."""
+        data = self.read(key)
+        if data is None:
+            return None
+        try:
+            return unpack_branch(data, root)
+        except Exception as e:
+            self.discard(key, e)
+            return None
+
+    def discard(self, key, error):
+        """ Removes an entry that was read, counting it as a hit, but could not be
+        loaded, and counts it as a miss instead."""
+        logger.warning("discarding unreadable cache entry %s: %s", self.entry_path(key), error)
+        self.entry_path(key).unlink(missing_ok=True)
+        self.hits -= 1
+        self.misses += 1
+
+    def read(self, key):
+        """ Returns the packed branch data for key, or None on a miss."""
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def store(self, key, parser, first_node_id, link_targets_before):
+        """ Saves the result of a just completed parse. The link targets that the parse
+        added to the root are saved with it so they can be added back on load."""
+        try:
+            data = pack_branch(parser, first_node_id, link_targets_before)
+        except (pickle.PicklingError, RecursionError, TypeError) as e:
+            logger.warning("cannot cache parse of %s: %s", parser.source, e)
+            return False
+        self.write(key, data)
+        return True
+
+    def write(self, key, data):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.entry_path(key)
+        tmp_path = Path(str(path) + f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*.pickle"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        while total > self.max_bytes and len(entries) > 1:
+            mtime, size, path = entries.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+            self.evictions += 1
+
+    def get_stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def log_stats(self):
+        logger.info("parse cache %s: %d hits, %d misses, %d evictions",
+                    self.cache_dir, self.hits, self.misses, self.evictions)
+
+
+def pack_branch(parser, first_node_id, link_targets_before):
+    """ Pickles the branch of a just completed parse, without the rest of the tree,
+    together with the link targets that the parse added to the root."""
+    branch = parser.branch
+    root = parser.root
+    link_targets = []
+    for target_id, link_target in root.link_targets.items():
+        if link_targets_before.get(target_id, None) is not link_target:
+            link_targets.append((target_id, link_target))
+    entry = dict(branch=branch, link_targets=link_targets,
+                 id_count=root.node_id - first_node_id + 1)
+    buff = io.BytesIO()
+    buff.write(entry_header(root.source))
+    _BranchPickler(buff, branch).dump(entry)
+    return buff.getvalue()
+
+def unpack_branch(data, root):
+    """ Reverses pack_branch, attaching the branch to the tree under root, or making it
+    the trunk of a new Root if root is None. Returns the branch's DocParser."""
+    root_source, header_size = read_entry_header(data)
+    if root is None:
+        root = Root(root_source)
+    entry = _BranchUnpickler(io.BytesIO(data[header_size:]), root).load()
+    attach_branch(entry, root)
+    return entry['branch'].parser
+
+def attach_branch(entry, root):
+    branch = entry['branch']
+    if root.trunk is None:
+        root.trunk = branch
+        branch.parent = root
+    else:
+        branch.parent = root.trunk
+        root.trunk.add_node(branch)
+    # Shift the node ids so they follow on from whatever is already in the tree,
+    # keeping the gaps so that the result matches a fresh parse exactly
+    shift = root.node_id + 1 - branch.node_id
+    for node in subtree_nodes(branch):
+        node.node_id += shift
+        root.add_to_index(node)
+        if isinstance(node, Heading):
+            root.add_heading(node)
+    if branch.last_node_id is not None:
+        branch.last_node_id += shift
+    # the outline is by node id
+    branch.make_outline()
+    root.node_id += entry['id_count']
+    for target_id, link_target in entry['link_targets']:
+        root.link_targets[target_id] = link_target
+    root.link_graph = None
+
+def entry_header(root_source):
+    # The root source is stored ahead of the pickle so that a cached first
+    # file can create its Root before the branch is loaded
+    encoded = str(root_source).encode('utf-8')
+    return len(encoded).to_bytes(4, 'big') + encoded
+
+def read_entry_header(data):
+    size = int.from_bytes(data[:4], 'big')
+    return data[4:4 + size].decode('utf-8'), 4 + size
@@ -7,6 +7,8 @@ import subprocess
 from subprocess import Popen
 import logging
 from roam2doc.io import parse_fileset, parse_one_file, parse_directory, parse_from_filelist 
+from roam2doc.cache import ParseCache
+from roam2doc.watch import WatchedInput, run_watch
 from roam2doc.setup_logging import setup_logging
 
 logger = logging.getLogger('roam2doc-cli')
@@ -59,6 +61,44 @@ def setup_parser():
         action="store_true",
         help="Allow overwriting existing output file (default: False)"
     )
+    parser.add_argument(
+        "--coalesce",
+        action="store_true",
+        help="Merge runs of blank lines and of plain paragraph text lines into single nodes, for smaller output"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes to parse multiple input files with (default: 1)"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and rewrite the output whenever an input or included file changes"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory for cached parse results (default: $XDG_CACHE_HOME/roam2doc or ~/.cache/roam2doc)"
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=256,
+        help="Remove least recently used cache entries when the cache grows past this size (default: 256)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Parse every file, without reading or writing the parse cache"
+    )
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Print the parse cache hit, miss and eviction counts as json to stderr after parsing"
+    )
     res = check_for_html2pdf()
     if res:
         help = "Use wkhtmltopdf to convert output to PDF"
@@ -140,47 +180,86 @@ def process_input(args):
 
 
     input_path = Path(args.input)
+
+    cache = None
+    if not getattr(args, 'no_cache', True):
+        cache = ParseCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024)
     
     # Determine input type and parse accordingly
-    if input_path.is_dir():
-        parsers = parse_directory(input_path)
+    jobs = getattr(args, 'jobs', 1)
+    watch = getattr(args, 'watch', False)
+    if watch:
+        if output_path is None:
+            logger.error("--watch needs an output file name with --output or -o")
+            raise SystemExit(1)
+        watched_input = WatchedInput(input_path, cache=cache, jobs=jobs)
+        parsers = watched_input.build()
+    elif input_path.is_dir():
+        parsers = parse_directory(input_path, cache=cache, jobs=jobs)
     elif input_path.suffix == '.org':
-        parser = parse_one_file(input_path)
+        parser = parse_one_file(input_path, cache=cache)
         parsers = [parser,]
     else:
-        parsers = parse_from_filelist(input_path)
+        parsers = parse_from_filelist(input_path, cache=cache, jobs=jobs)
+    cache_stats = cache is not None and getattr(args, 'cache_stats', False)
+    if cache_stats:
+        print(json.dumps(cache.get_stats()), file=sys.stderr)
+
+    res = write_document(args, parsers, output_path)
+    if watch:
+        def rebuilt(new_parsers):
+            nonlocal parsers
+            parsers = new_parsers
+            if cache_stats:
+                print(json.dumps(cache.get_stats()), file=sys.stderr)
+            write_document(args, parsers, output_path)
+            logger.info("%s rewritten", output_path)
+        logger.info("watching for changes, interrupt to stop")
+        try:
+            run_watch(watched_input, rebuilt)
+        except KeyboardInterrupt:
+            pass
+        return parsers
+    return res
 
+def write_document(args, parsers, output_path):
     root = parsers[0].root
+    if getattr(args, 'coalesce', False):
+        root.coalesce()
 
-    # Handle output
-    if args.doc_type == "html" or (hasattr(args, 'wk_pdf') and args.wk_pdf):
-        output_text = root.to_html(include_json=args.include_json)
-    elif args.doc_type == "json":
+    # Handle output, html and latex are written straight to the output as they are rendered
+    wk_pdf = hasattr(args, 'wk_pdf') and args.wk_pdf
+    output_text = None
+    if args.doc_type == "json" and not wk_pdf:
         output_text = json.dumps(root.to_json_dict())
-    elif args.doc_type == "pdf" or args.doc_type == "latex":
-        output_text = root.to_latex(grokify=args.grokify)
-        
-    elif args.doc_type == "json":
-        output_text = json.dumps(root.to_json_dict(), indent=2)
+
+    def write_output(f):
+        if output_text is not None:
+            f.write(output_text)
+        elif (args.doc_type == "pdf" or args.doc_type == "latex") and not wk_pdf:
+            root.write_latex(f, grokify=args.grokify)
+        else:
+            root.write_html(f, include_json=args.include_json)
+
     if output_path:
         y = list(output_path.parts)[:-1]
         y.append(output_path.stem)
         stem_path = Path(*y)
-        if hasattr(args, 'wk_pdf') and args.wk_pdf:
+        if wk_pdf:
             tmp_path = Path(str(output_path) + ".html")
             with open(tmp_path, 'w', encoding="utf-8") as f:
-                f.write(output_text)
+                write_output(f)
             convert_html_to_pdf(tmp_path, output_path)
             tmp_path.unlink()
             return parsers
         elif args.doc_type == "pdf":
             tex_path = str(stem_path) + ".tex"
             with open(tex_path, 'w', encoding="utf-8") as f:
-                f.write(output_text)
+                write_output(f)
             convert_latex_to_pdf(tex_path, output_path)
         elif args.doc_type in ['html', 'json', 'latex']:
             with open(output_path, 'w', encoding="utf-8") as f:
-                f.write(output_text)
+                write_output(f)
         else:
             raise Exception(f"don't know how to do file on doc_type {args.doc_type}")
 
@@ -195,7 +274,8 @@ def process_input(args):
                     f.write(str(p) + "\n")
         logger.info(f"{args.doc_type.upper()} written to {output_path}")
     elif args.doc_type in ['html', 'json', 'latex']:
-        print(output_text)
+        write_output(sys.stdout)
+        sys.stdout.write("\n")
     else:
         print(f"doc_type {args.doc_type} requires an ouput file name with --output or -o")
         return None
@@ -0,0 +1,102 @@
+from bisect import bisect_right
+
+
+class IncludedDocument:
+    """ The lines of an org file with its includes expanded, kept as a piece table
+    instead of a copy. Each piece refers to a run of lines in the line buffer of one
+    source file, along with the heading level that an include statement added to
+    that run, so the buffers are shared by every document that includes the file
+    and the heading stars are only added when a line is read.
+
+    Reads like a list of lines, which is all DocParser needs, and can also tell
+    the file and line number that any line came from.
+    """
+
+    def __init__(self):
+        # (path, buffer, start, count, level, origin_line) with the lines
+        # being buffer[start:start + count], the first of them being line
+        # origin_line of the file at path
+        self.pieces = []
+        self.piece_starts = []
+        self.length = 0
+
+    def add_lines(self, path, buffer, start, end, level=None):
+        """ Adds buffer[start:end], the lines from start up to end of the file at path."""
+        if end <= start:
+            return
+        self.add_piece(path, buffer, start, end - start, level, start)
+
+    def add_line(self, path, line, origin_line):
+        """ Adds a line that isn't in a file's buffer as is, such as the heading
+        given on an include line, which came from origin_line of the file at path."""
+        self.add_piece(path, [line,], 0, 1, None, origin_line)
+
+    def add_piece(self, path, buffer, start, count, level, origin_line):
+        self.pieces.append((path, buffer, start, count, level, origin_line))
+        self.piece_starts.append(self.length)
+        self.length += count
+
+    def find_piece(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("list index out of range")
+        piece_index = bisect_right(self.piece_starts, index) - 1
+        return self.pieces[piece_index], index - self.piece_starts[piece_index]
+
+    def origin(self, index):
+        """ Returns the path of the file that line index came from and its line
+        number in that file."""
+        piece, offset = self.find_piece(index)
+        path, buffer, start, count, level, origin_line = piece
+        return path, origin_line + offset
+
+    def iter_range(self, first, last):
+        if first >= last:
+            return
+        piece_index = bisect_right(self.piece_starts, first) - 1
+        pos = first
+        while pos < last:
+            path, buffer, start, count, level, origin_line = self.pieces[piece_index]
+            offset = pos - self.piece_starts[piece_index]
+            stop = min(count, last - self.piece_starts[piece_index])
+            for line in buffer[start + offset:start + stop]:
+                yield shift_heading(line, level)
+            pos = self.piece_starts[piece_index] + stop
+            piece_index += 1
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iter_range(0, self.length)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            first, last, step = index.indices(self.length)
+            if step != 1:
+                return list(self.iter_range(0, self.length))[index]
+            return list(self.iter_range(first, last))
+        piece, offset = self.find_piece(index)
+        path, buffer, start, count, level, origin_line = piece
+        return shift_heading(buffer[start + offset], level)
+
+    def __eq__(self, other):
+        if isinstance(other, (IncludedDocument, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def get_text(self):
+        return '\n'.join(self)
+
+    def __str__(self):
+        return self.get_text()
+
+
+def shift_heading(line, level):
+    # Without a level spec on the include, the doc properties
+    # will get ignored. With the level spec the property
+    # drawer looks like it belongs to the heading.
+    if level and line.startswith('*'):
+        return "*" * level + line
+    return line
@@ -0,0 +1,137 @@
+import re
+import threading
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+logger = logging.getLogger('roam2doc.images')
+
+# Leading bytes of each format, checked in order
+magic_numbers = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'%PDF-', 'pdf'),
+)
+# What the file command used to call an image, pdf is a "document" to it and
+# is not something the html output could show in an img tag anyway
+image_types = ('png', 'jpeg', 'gif', 'svg', 'webp')
+# enough to get past an xml declaration and comments to the svg tag
+head_size = 1024
+
+# Finds the target of every [[target]] or [[target][description]] link
+link_pattern = re.compile(r'\[\[([^\]]+)\]')
+# the lookups are mostly waiting on the filesystem
+prefetch_threads = 16
+
+# Keyed by resolved path, holding (mtime_ns, size, type), shared by every
+# parser in the process so each file is only read once per run
+_type_by_path = {}
+# Keyed by the path built by link_target_path, filled by prefetch_link_files
+# and trusted without checking the file again until the next prefetch or clear
+_prefetched = {}
+_lock = threading.Lock()
+
+
+def detect_file_type(path):
+    """ Returns the format of the file at path from its leading bytes, one of png,
+    jpeg, gif, svg, webp or pdf, or None for anything else, including a path that
+    does not exist or is not a file. Results are remembered until the file's
+    modification time or size changes."""
+    path = Path(path).resolve()
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    with _lock:
+        known = _type_by_path.get(path)
+    if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+        return known[2]
+    file_type = None
+    if path.is_file():
+        try:
+            with open(path, "rb") as f:
+                head = f.read(head_size)
+        except OSError:
+            head = b''
+        file_type = type_from_head(head)
+    with _lock:
+        _type_by_path[path] = (stat.st_mtime_ns, stat.st_size, file_type)
+    return file_type
+
+def type_from_head(head):
+    for magic, file_type in magic_numbers:
+        if head.startswith(magic):
+            return file_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if text.startswith(b'<') and b'<svg' in text.lower():
+        return 'svg'
+    return None
+
+def link_file_type(path):
+    """ Returns detect_file_type for a path built by link_target_path, taking the
+    answer from the last prefetch when there is one."""
+    with _lock:
+        if path in _prefetched:
+            return _prefetched[path]
+    return detect_file_type(path)
+
+def is_image_file(path):
+    return link_file_type(path) in image_types
+
+def link_target_path(target_text, root_source):
+    """ Returns the path that a link to something other than a uri would name if it
+    were a file, relative to the directory of the root source."""
+    prefix = 'file:'
+    if target_text.lower().startswith(prefix):
+        file_part = target_text[len(prefix):]
+    else:
+        file_part = target_text
+    doc_path = Path(root_source).parent
+    if file_part.startswith('./'):
+        return Path(doc_path, file_part[2:])
+    return Path(doc_path, file_part)
+
+def find_link_paths(lines, root_source):
+    paths = set()
+    for line in lines:
+        if '[[' not in line:
+            continue
+        for match in link_pattern.finditer(line):
+            target_text = match.group(1)
+            if "//" not in target_text:
+                paths.add(link_target_path(target_text, root_source))
+    return paths
+
+def prefetch_link_files(documents, root_source, threads=None):
+    """ Finds the file links in the documents, each a string or a sequence of lines,
+    and works out which of them are images using a pool of threads, so that the
+    parsers can look the answer up instead of waiting on the filesystem for each
+    link in turn. Replaces the results of any earlier prefetch."""
+    paths = set()
+    for doc in documents:
+        if isinstance(doc, str):
+            doc = doc.split('\n')
+        paths.update(find_link_paths(doc, root_source))
+    paths = list(paths)
+    results = {}
+    if paths:
+        with ThreadPoolExecutor(max_workers=threads or prefetch_threads) as executor:
+            for path, file_type in zip(paths, executor.map(detect_file_type, paths)):
+                results[path] = file_type
+    logger.debug("prefetched %d link paths", len(results))
+    with _lock:
+        _prefetched.clear()
+        _prefetched.update(results)
+    return results
+
+def clear_prefetch():
+    with _lock:
+        _prefetched.clear()
+
+def clear_type_cache():
+    with _lock:
+        _type_by_path.clear()
+        _prefetched.clear()
@@ -3,152 +3,356 @@ import logging
 from pathlib import Path
 from glob import glob
 import re
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from roam2doc.parse import DocParser
+from roam2doc.cache import pack_branch, unpack_branch
+from roam2doc.document import IncludedDocument
+from roam2doc.images import prefetch_link_files
 logger = logging.getLogger('roam2doc.io')
 
 heading_pattern = re.compile(r'^(?P<stars>\*+)[ \t]*(?P<heading>.*)?')
 
 
-class FilesToParsers:
+class IncludeResolver:
+    """ Expands the #+BEGIN_FILE_INCLUDE blocks in files, following includes of includes.
+    Each file is read and scanned for include blocks only once no matter how many
+    files include it, and the expansion follows the include graph in a single pass,
+    so a file that ends up including itself is reported rather than followed.
 
-    def __init__(self, file_list):
-        self.file_list = [] 
-        self.skip_files = []
-        self.parsers = []
-        for filepath in file_list:
-            self.file_list.append(Path(filepath).resolve())
+    A heading given on the include line shifts the headings of the included file
+    by its level, but not the headings of the files that one includes in turn.
+    Relative include paths are relative to the directory of the including file.
+    """
 
-    def do_file_includes(self, content_lines, path):
-        include_paths = []
-        bad_include_paths = []
-        skip_counter = 0
-        new_lines = []
-        for pos, line in enumerate(content_lines):
-            if skip_counter > 0:
-                skip_counter -= 1
-                continue
-            if not line.upper().startswith("#+BEGIN_FILE_INCLUDE"):
-                new_lines.append(line)
+    def __init__(self):
+        self.lines_by_path = {}
+        self.blocks_by_path = {}
+        self.exists_by_path = {}
+        # each one a list of paths, the last one being included by the one before
+        # it and also being the first one
+        self.cycles = []
+
+    def forget(self, paths):
+        """ Drops the saved contents of paths, for when they have changed on disk."""
+        for path in paths:
+            self.lines_by_path.pop(path, None)
+            self.blocks_by_path.pop(path, None)
+            self.exists_by_path.pop(path, None)
+
+    def read_lines(self, path):
+        if path not in self.lines_by_path:
+            with open(path, "r", encoding="utf-8") as f:
+                self.lines_by_path[path] = f.read().split('\n')
+        return self.lines_by_path[path]
+
+    def exists(self, path):
+        # only a found file is remembered, a missing one may turn up later
+        if path not in self.exists_by_path:
+            if not path.exists():
+                return False
+            self.exists_by_path[path] = True
+        return True
+
+    def find_blocks(self, path):
+        """ Returns a list of dicts, one per include block in the file, giving the line
+        range of the block and the include specs in it."""
+        if path in self.blocks_by_path:
+            return self.blocks_by_path[path]
+        lines = self.read_lines(path)
+        blocks = []
+        pos = 0
+        while pos < len(lines):
+            if not lines[pos].upper().startswith("#+BEGIN_FILE_INCLUDE"):
+                pos += 1
                 continue
-            check_paths = []
-            rpos = 0
-            rest = content_lines[pos+1:]
-            rline = rest[rpos]
-            while not rline.upper().startswith("#+END_FILE_INCLUDE"):
+            start = pos
+            specs = []
+            pos += 1
+            while pos < len(lines) and not lines[pos].upper().startswith("#+END_FILE_INCLUDE"):
+                tmp = lines[pos].strip().split()
+                pos += 1
+                if len(tmp) == 0:
+                    continue
                 first_line = None
-                tmp = rline.strip().split()
-                check_path = tmp[0]
                 if len(tmp) > 1:
                     first_line = ' '.join(tmp[1:])
-                check_paths.append(dict(fpath=check_path, first_line=first_line))
-                rpos += 1
-                if rpos == len(rest):
-                    raise Exception(f'End of file reached before include file section in {path} terminated')
-                rline = rest[rpos]
-                skip_counter += 1
-            skip_counter += 1
-            for check_spec in check_paths:
-                check_path = check_spec['fpath']
-                if check_path == "":
+                check_path = Path(tmp[0])
+                if not check_path.is_absolute():
+                    check_path = Path(path.parent, check_path)
+                specs.append(dict(fpath=check_path.resolve(), first_line=first_line, line=pos - 1))
+            if pos == len(lines):
+                raise Exception(f'End of file reached before include file section in {path} terminated')
+            blocks.append(dict(start=start, end=pos, specs=specs))
+            pos += 1
+        self.blocks_by_path[path] = blocks
+        return blocks
+
+    def expand(self, path):
+        """ Returns an IncludedDocument holding the lines of the file at path with all
+        the includes expanded, the list of files included and the list of included
+        files that don't exist, the lists being None if empty. An include that would
+        make a cycle is left out and recorded in cycles instead."""
+        path = Path(path).resolve()
+        doc = IncludedDocument()
+        include_paths = []
+        bad_paths = []
+        self.expand_file(path, None, [path,], doc, include_paths, bad_paths)
+        return doc, include_paths or None, bad_paths or None
+
+    def expand_file(self, path, level, stack, doc, include_paths, bad_paths):
+        lines = self.read_lines(path)
+        pos = 0
+        for block in self.find_blocks(path):
+            doc.add_lines(path, lines, pos, block['start'], level)
+            pos = block['end'] + 1
+            for spec in block['specs']:
+                check_path = spec['fpath']
+                if not self.exists(check_path):
+                    bad_paths.append(check_path)
                     continue
-                if check_path.startswith('/'):
-                    check_path = Path(check_path)
-                else:
-                    # assume it is realtive to including path
-                    dirname = path.parent
-                    check_path = Path(dirname, check_path)
-                if not check_path.exists():
-                    bad_include_paths.append(check_path)
+                if check_path in stack:
+                    cycle = stack[stack.index(check_path):] + [check_path,]
+                    logger.error("include cycle %s", " -> ".join(str(p) for p in cycle))
+                    self.cycles.append(cycle)
                     continue
                 include_paths.append(check_path)
-                self.skip_files.append(check_path)
-                logger.warn("including %s", str(check_path))
-                level = None
-                if check_spec['first_line']:
-                    new_lines.append(check_spec['first_line'])
-                    res = heading_pattern.match(check_spec['first_line'])
+                logger.warning("including %s", str(check_path))
+                sub_level = None
+                if spec['first_line']:
+                    doc.add_line(path, spec['first_line'], spec['line'])
+                    res = heading_pattern.match(spec['first_line'])
                     if res:
-                        level = len(res.groupdict()['stars'])
-                with open(check_path, "r", encoding="utf-8") as f:
-                    include_contents = f.read()
-                if level:
-                    extra = "*" * level
-                    for line in include_contents.split('\n'):
-                        if line.startswith('*'):
-                            new_lines.append(f'{extra}{line}')
-                        else:
-                            new_lines.append(line)
-                else:
-                    # Without a level spec on the include, the doc properties
-                    # will get ignored. With the level spec the property
-                    # drawer looks like it belongs to the heading.
-                    new_lines.extend(include_contents.split('\n'))
-            contents = '\n'.join(new_lines)
-        count = len(include_paths)
-        if count:
-            # do it again
-            new_lines, sub_files,sub_bads = self.do_file_includes(new_lines, path)
-            if sub_files:
-                include_paths.extend(sub_files)
-            if sub_bads:
-                bad_include_paths.extend(sub_bads)
-            return new_lines, include_paths, bad_include_paths
-        else:
-            return content_lines, None, None
-        
+                        sub_level = len(res.groupdict()['stars'])
+                stack.append(check_path)
+                self.expand_file(check_path, sub_level, stack, doc, include_paths, bad_paths)
+                stack.pop()
+        doc.add_lines(path, lines, pos, len(lines), level)
+
+
+class FilesToParsers:
+
+    def __init__(self, file_list, cache=None, jobs=1):
+        self.file_list = [] 
+        self.skip_files = set()
+        self.include_resolver = IncludeResolver()
+        self.parsers = []
+        # a ParseCache, or None to parse every file
+        self.cache = cache
+        self.jobs = jobs
+        self.failed_files = []
+        self.includes_by_path = {}
+        # the includes that were not found, by the file that names them
+        self.bad_includes_by_path = {}
+        self.parsers_by_path = {}
+        for filepath in file_list:
+            self.file_list.append(Path(filepath).resolve())
+
     def run_parsers(self):
         root_parser = None
         parsers = []
         contents_by_path = {}
         includes_by_path = {}
         bad_paths_by_path = {}
+        cycles_by_path = {}
         for path in self.file_list:
             if path in self.skip_files:
                 continue
-            with open(path, "r", encoding="utf-8") as f:
-                contents = f.read()
-            with_includes,included,bad_paths = self.do_file_includes(contents.split('\n'), path)
-            contents_by_path[path] = '\n'.join(with_includes)
+            cycle_count = len(self.include_resolver.cycles)
+            contents, included, bad_paths = self.read_with_includes(path)
+            contents_by_path[path] = contents
             includes_by_path[path] = included
             if bad_paths:
-                bad_paths_by_path[path] = bad_includes
-        for path in self.file_list:
-            if path not in self.skip_files:
-                contents = contents_by_path[path]
-                if root_parser is None:
-                    root_parser = parser = DocParser(contents, str(path.parts[-1]), included_files=includes_by_path[path])
-                else:
-                    parser = DocParser(contents, str(path.parts[-1]), root=root_parser.root,
-                                       included_files=includes_by_path[path])
-                parsers.append(parser)
-                parser.parse()
-        if len(bad_paths_by_path) > 0:
+                bad_paths_by_path[path] = bad_paths
+            if len(self.include_resolver.cycles) > cycle_count:
+                cycles_by_path[path] = self.include_resolver.cycles[cycle_count:]
+        todo = [path for path in self.file_list if path not in self.skip_files]
+        if todo:
+            # link paths are relative to the first file's name, as in the parser
+            prefetch_link_files(contents_by_path.values(), str(todo[0].parts[-1]))
+        if self.jobs > 1 and len(todo) > 1:
+            parsers = self.run_parallel(todo, contents_by_path, includes_by_path)
+            todo = []
+        for path in todo:
+            contents = contents_by_path[path]
+            source = str(path.parts[-1])
+            root = None
+            if root_parser is not None:
+                root = root_parser.root
+            parser = self.run_one_parser(contents, source, root, includes_by_path[path])
+            if root_parser is None:
+                root_parser = parser
+            parsers.append(parser)
+            self.parsers_by_path[path] = parser
+        self.includes_by_path = includes_by_path
+        self.bad_includes_by_path = bad_paths_by_path
+        self.parsers = parsers
+        self.resolve_links()
+        if self.cache:
+            self.cache.evict()
+            self.cache.log_stats()
+        if len(bad_paths_by_path) > 0 or len(cycles_by_path) > 0:
             with open('bad_includes.list', 'w') as f:
                 for path,bads in bad_paths_by_path.items():
                     f.write(f"included_from {path}\n")
                     for bad in bads:
                         f.write(f"{bad}\n")
                     f.write(f"\n")
+                for path, cycles in cycles_by_path.items():
+                    f.write(f"cycles_from {path}\n")
+                    for cycle in cycles:
+                        f.write(" -> ".join(str(p) for p in cycle) + "\n")
+                    f.write(f"\n")
+        return parsers
+
+    def resolve_links(self):
+        """ Runs the link resolution pass over the combined tree once all the files are
+        in it and logs the links that go nowhere."""
+        if len(self.parsers) == 0:
+            return None
+        root = self.parsers[0].root
+        graph = root.resolve_links()
+        for broken in root.get_broken_link_report():
+            logger.info("no target for link '%s' in %s at line %d", broken['target_text'],
+                        broken['source_file'], broken['source_line'])
+        return graph
+
+    def read_with_includes(self, path):
+        """ Returns the IncludedDocument for path, the files it includes and the
+        includes that were not found."""
+        doc, included, bad_paths = self.include_resolver.expand(path)
+        if included:
+            self.skip_files.update(included)
+        return doc, included, bad_paths
+
+    def run_one_parser(self, contents, source, root, included_files):
+        if self.cache is None:
+            parser = DocParser(contents, source, root=root, included_files=included_files)
+            parser.parse()
+            return parser
+        if root is None:
+            root_source = source
+        else:
+            root_source = root.source
+        key = self.cache.make_key(contents, source, root_source)
+        parser = self.cache.load(key, root)
+        if parser is not None:
+            logger.debug("restored parse of %s from cache", source)
+            parser.included_files = included_files
+            return parser
+        link_targets_before = {}
+        if root is not None:
+            link_targets_before = dict(root.link_targets)
+        parser = DocParser(contents, source, root=root, included_files=included_files)
+        parser.parse()
+        self.cache.store(key, parser, parser.branch.node_id, link_targets_before)
+        return parser
+
+    def run_parallel(self, paths, contents_by_path, includes_by_path):
+        """ Parses each file into a tree of its own in a worker process, then attaches
+        the branches to one tree in file order, so the node ids and link targets come
+        out the same as they would from parsing the files one after the other. A file
+        that fails to parse is logged, recorded in failed_files and left out.
+        """
+        root_source = str(paths[0].parts[-1])
+        packed = {}
+        keys = {}
+        # the paths whose packed data came from the cache
+        from_cache = set()
+        with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+            futures = {}
+            for path in paths:
+                source = str(path.parts[-1])
+                if self.cache:
+                    keys[path] = self.cache.make_key(contents_by_path[path], source, root_source)
+                    data = self.cache.read(keys[path])
+                    if data is not None:
+                        packed[path] = data
+                        from_cache.add(path)
+                        continue
+                futures[path] = executor.submit(parse_to_branch_data, contents_by_path[path], source)
+            for path, future in futures.items():
+                try:
+                    packed[path] = future.result()
+                except BrokenProcessPool:
+                    # parse it here instead
+                    packed[path] = None
+                    continue
+                except Exception as e:
+                    logger.error("parse of %s failed: %s", path, e)
+                    self.failed_files.append(path)
+                    continue
+                if self.cache and packed[path] is not None:
+                    self.cache.write(keys[path], packed[path])
+        root = None
+        parsers = []
+        for path in paths:
+            if path not in packed:
+                continue
+            parser = None
+            if packed[path] is not None:
+                try:
+                    parser = unpack_branch(packed[path], root)
+                except Exception as e:
+                    if path in from_cache:
+                        self.cache.discard(keys[path], e)
+                    else:
+                        logger.warning("could not load parse result for %s, parsing again: %s", path, e)
+            if parser is None:
+                try:
+                    parser = DocParser(contents_by_path[path], str(path.parts[-1]), root=root)
+                    parser.parse()
+                except Exception as e:
+                    logger.error("parse of %s failed: %s", path, e)
+                    self.failed_files.append(path)
+                    continue
+            parser.included_files = includes_by_path[path]
+            root = parser.root
+            parsers.append(parser)
+            self.parsers_by_path[path] = parser
+        if len(parsers) == 0:
+            raise Exception(f"no files could be parsed, failed {[str(p) for p in self.failed_files]}")
         return parsers
 
-def parse_fileset(filepaths):
-    ftp = FilesToParsers(filepaths)
+def parse_to_branch_data(contents, source):
+    """ Runs in a worker process for FilesToParsers.run_parallel, returns the packed
+    branch, or None if it can't be pickled so the caller has to parse it itself."""
+    parser = DocParser(contents, source)
+    parser.parse()
+    try:
+        return pack_branch(parser, parser.branch.node_id, {})
+    except (pickle.PicklingError, RecursionError, TypeError):
+        return None
+
+def parse_fileset(filepaths, cache=None, jobs=1):
+    ftp = FilesToParsers(filepaths, cache=cache, jobs=jobs)
     return ftp.run_parsers()
 
-def parse_one_file(filepath):
+def parse_one_file(filepath, cache=None):
     filepaths = [filepath,]
-    ftp = FilesToParsers(filepaths)
+    ftp = FilesToParsers(filepaths, cache=cache)
     return ftp.run_parsers()[0]
 
-def parse_directory(dirpath):
+def parse_directory(dirpath, cache=None, jobs=1):
+    targets = list_directory(dirpath)
+    ftp = FilesToParsers(targets, cache=cache, jobs=jobs)
+    return ftp.run_parsers()
+
+def list_directory(dirpath):
     path = Path(dirpath)
     targets = []
-    for filepath in path.glob('*.org'):
+    # sorted so that node ids and link target precedence don't depend on directory order
+    for filepath in sorted(path.glob('*.org')):
         targets.append(filepath)
-    ftp = FilesToParsers(targets)
+    return targets
+
+def parse_from_filelist(listfile, cache=None, jobs=1):
+    targets = read_filelist(listfile)
+    ftp = FilesToParsers(targets, cache=cache, jobs=jobs)
     return ftp.run_parsers()
 
-def parse_from_filelist(listfile):
+def read_filelist(listfile):
     filepath = Path(listfile)
     with open(filepath, "r", encoding="utf-8") as f:
         contents = f.read()
@@ -160,7 +364,6 @@ def parse_from_filelist(listfile):
             else:
                 path = Path(line)
             targets.append(path)
-    ftp = FilesToParsers(targets)
-    return ftp.run_parsers()
+    return targets
             
     
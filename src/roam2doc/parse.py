@@ -1,12 +1,13 @@
 import re
 import logging
 import typing
-from pathlib import Path
 from collections import defaultdict
-import subprocess
-from enum import Enum
+from array import array
+from bisect import bisect_left
+from enum import Enum, IntEnum
 from pprint import pformat
-from roam2doc.tree import (Root, Branch, Section, Heading, Text, Paragraph, BlankLine, TargetText,
+from roam2doc.images import is_image_file, link_target_path
+from roam2doc.tree import (Root, Branch, Section, subtree_nodes, Heading, Text, Paragraph, BlankLine, TargetText,
                            LinkTarget, BoldText, ItalicText,
                            UnderlinedText, LinethroughText, InlineCodeText,
                            VerbatimText, CenterBlock, QuoteBlock, CodeBlock,
@@ -16,11 +17,18 @@ from roam2doc.tree import (Root, Branch, Section, Heading, Text, Paragraph, Blan
                            DefinitionListItemTitle, DefinitionListItemDescription,
                            Table, TableRow, TableCell, Link, InternalLink, Image)
 
+def split_lines(text):
+    if isinstance(text, str):
+        return text.split('\n')
+    return text
+
 class DocParser:
 
     def __init__(self, text, source, root=None, included_files=None):
-        self.text = text
-        self.lines = text.split('\n')
+        # text is either a string or a sequence of lines, such as the
+        # IncludedDocument that io builds when expanding includes
+        self.lines = split_lines(text)
+        self.line_classes = LineClasses(self.lines)
         self.source = str(source)
         self.included_files = included_files
         if root is None:
@@ -37,6 +45,7 @@ class DocParser:
         self.sections = []
         self.match_log_format =    "%15s %12s matched line %s"
         self.no_match_log_format = "%15s %12s matched line %s"
+        self.section_spans = []
         self.parser_stack = []
         self.parse_problems = []
         self.parse_start_callback = None
@@ -81,30 +90,14 @@ class DocParser:
         self.parse_problems.append(problem_dict)
     
     def find_first_section(self, offset=0):
-        pos = offset
-        start_pos = pos
-        end_pos = 0
-        level = 1
-        heading_text = None
         # if the first line is not a heading, then we don't have one,
         # we have a zeroth section with no heading
         # however, it the zeroth section is nothing but properties,
         # followed by a heading, then we will treat that heading
         # as starting the first section
-        tool_box = ToolBox(self)
-        heading_matcher = tool_box.get_matcher(MatcherType.heading)
-        elem = heading_matcher.match_line(self.lines[pos])
-        if elem:
-            stars =  elem['groupdict']['stars']
-            level = len(stars)
-            heading_text = elem['groupdict']['heading']
-            pos += 1
-        while pos < len(self.lines):
-            if heading_matcher.match_line(self.lines[pos]):
-                break
-            pos += 1
-        end_pos = pos - 1
-        return SectionParse(self, offset, end_pos)
+        self.section_spans = self.line_classes.split_sections(offset)
+        span = self.section_spans[0]
+        return SectionParse(self, span.start, span.end, span=span)
 
     def parse_file_start(self):
         """ This method is broken out from the parse method to make it easier to build
@@ -135,35 +128,14 @@ class DocParser:
         """ This method is broken out from the parse method to make it easier to build
         child classes for test, so that the test version can poke at the steps of the process """
         first_section = self.parse_file_start()
-        start_offset = first_section.end
         self.sections.append(first_section)
         self.logger.info("found level 1 section %d lines %d to %s of %d",
                          0, 
                          first_section.start,
                          first_section.end,
                          len(self.lines))
-        tool_box = ToolBox(self)
-        pos = start_offset + 1
-        starts = []
-        while pos < len(self.lines):
-            elem  = tool_box.get_next_element(pos, len(self.lines))
-            if elem is None:
-                break
-            pos = elem['match_line']
-            pos += 1
-            if elem['match_type'] != MatcherType.heading:
-                continue
-            stars =  elem['matched_contents']['stars']
-            level = len(stars)
-            starts.append(elem['match_line'])
-        index = 0
-        for start in starts:
-            if index == len(starts) - 1:
-                end = len(self.lines) - 1
-            else:
-                end = starts[index+1] -1
-            index += 1
-            section = SectionParse(self, start, end)
+        for span in self.section_spans[1:]:
+            section = SectionParse(self, span.start, span.end, span=span)
             self.logger.info("found level 1 section %d lines %d to %s of %d",
                         len(self.sections),
                         section.start,
@@ -173,27 +145,86 @@ class DocParser:
                 
     def parse(self):
         self.find_sections()
-        index = 0
-        for section in self.sections:
-            self.current_section = section
-            self.logger.info("running parser for level 1 section %d lines %d to %s of %d",
-                             index,
-                             section.start + 1,
-                             section.end + 1,
-                             len(self.lines))
-            self.push_parser(section)
-            section.parse()
-            if index == 0:
-                if self.doc_properties is not None:
-                    if "ID" in self.doc_properties:
-                        raw = self.doc_properties['ID']
-                        self.logger.debug("adding link target for doc properties id %s", raw.lstrip())
-                        self.root.add_link_target(section.tree_node, raw.lstrip())
-            self.pop_parser(section)
-            index += 1
+        for index, section in enumerate(self.sections):
+            self.parse_section(index, section)
         self.branch.note_parse_done()
         return self.branch
 
+    def parse_section(self, index, section):
+        self.current_section = section
+        self.logger.info("running parser for level 1 section %d lines %d to %s of %d",
+                         index,
+                         section.start + 1,
+                         section.end + 1,
+                         len(self.lines))
+        self.push_parser(section)
+        section.parse()
+        if index == 0:
+            if self.doc_properties is not None:
+                if "ID" in self.doc_properties:
+                    raw = self.doc_properties['ID']
+                    self.logger.debug("adding link target for doc properties id %s", raw.lstrip())
+                    self.root.add_link_target(section.tree_node, raw.lstrip())
+        self.pop_parser(section)
+
+    def reparse(self, text):
+        """ Updates the branch to match a new version of the text, parsing only the level 1
+        sections whose lines have changed. Sections that are unchanged keep their tree nodes,
+        the ones after the change get their line numbers moved. A change to the file level
+        properties or title only causes the zeroth section, the one that holds the file
+        start, to be parsed again. Returns a dict with the counts of reused, removed and
+        added sections.
+        """
+        old_lines = self.lines
+        old_sections = self.sections
+        old_start = old_sections[0].start if old_sections else 0
+        old_keys = [old_lines[sp.start:sp.end + 1] for sp in old_sections]
+
+        self.lines = split_lines(text)
+        self.line_classes = LineClasses(self.lines)
+        self.doc_properties = None
+        self.doc_title = None
+        self.parse_problems = []
+        self.sections = []
+        self.find_sections()
+        new_sections = self.sections
+        new_keys = [self.lines[sp.start:sp.end + 1] for sp in new_sections]
+
+        limit = min(len(old_keys), len(new_keys))
+        prefix = 0
+        if old_lines[:old_start] == self.lines[:new_sections[0].start]:
+            # the zeroth section's heading can come from the file start
+            while prefix < limit and old_keys[prefix] == new_keys[prefix]:
+                prefix += 1
+        suffix = 0
+        # the zeroth section is only ever reused through the prefix
+        while (suffix < limit - max(prefix, 1)
+               and old_keys[-1 - suffix] == new_keys[-1 - suffix]):
+            suffix += 1
+
+        for index in range(prefix):
+            new_sections[index] = old_sections[index]
+        for count in range(1, suffix + 1):
+            old = old_sections[-count]
+            new = new_sections[-count]
+            delta = new.start - old.start
+            if delta != 0:
+                for node in subtree_nodes(old.tree_node):
+                    node.start_line += delta
+                    node.end_line += delta
+                old.start = new.start
+                old.end = new.end
+            old.span = new.span
+            new_sections[-count] = old
+
+        changed = new_sections[prefix:len(new_sections) - suffix]
+        for offset, section in enumerate(changed):
+            self.parse_section(prefix + offset, section)
+        removed_count = len(old_sections) - prefix - suffix
+        self.branch.splice_sections(prefix, removed_count, [sp.tree_node for sp in changed])
+        self.branch.note_parse_done()
+        return dict(reused=prefix + suffix, removed=removed_count, added=len(changed))
+
     def parse_properties(self, start, end):
         # :PROPERTIES:
         #  some number of property defs all starting with :
@@ -227,6 +258,9 @@ class DocParser:
 
 
 class ParseTool:
+    __slots__ = ('doc_parser', 'tree_node', 'start', 'end', 'parent_tree_node', 'keywords',
+                 'keyword_name', 'logger', 'start_callback', 'end_callback',
+                 'match_log_format', 'no_match_log_format')
 
     def __init__(self, doc_parser, start, end, parent_tree_node):
         self.doc_parser = doc_parser
@@ -258,6 +292,15 @@ class ParseTool:
                 if endpart != '':
                     self.keyword_name = endpart
             
+    def get_body_end(self):
+        # For the #+BEGIN_xxx wrapped elements, the last line of the
+        # contents is just before the paired end line. If the block
+        # was never closed the contents run to the end of our range.
+        pair = self.doc_parser.line_classes.find_block_end(self.start, self.end)
+        if pair is None:
+            return self.end
+        return pair - 1
+
     def get_parent_parser(self):
         # can't do this during init, not added to doc parser yet
         return self.doc_parser.get_parser_parent(self)
@@ -271,18 +314,26 @@ class ParseTool:
         return par
 
 class SectionParse(ParseTool):
+    __slots__ = ('level', 'heading_text', 'properties', 'span')
 
-    def __init__(self, doc_parser, start, end, parent_tree_node=None):
+    def __init__(self, doc_parser, start, end, parent_tree_node=None, span=None):
         self.start = start
         self.end = end
         self.level = 0
         self.heading_text = None
         self.properties = None
+        # a SectionSpan from the splitter, if it found a heading it
+        # already knows the level and text
+        self.span = span
         if parent_tree_node is None:
             parent_tree_node = doc_parser.branch
         super().__init__(doc_parser, start, end, parent_tree_node)
 
     def calc_level(self):
+        if self.span is not None and self.span.level is not None:
+            self.level = self.span.level
+            self.heading_text = self.span.heading_text
+            return True
         first_line = self.doc_parser.lines[self.start].lstrip()
         tool_box = ToolBox(self.doc_parser)
         matcher = tool_box.get_matcher(MatcherType.heading)
@@ -313,7 +364,11 @@ class SectionParse(ParseTool):
         self.tree_node = Section(self.parent_tree_node, self.start, self.end)
         heading = Heading(self.tree_node, self.start, self.start, self.level, self.heading_text)
         tool_box = ToolBox(self.doc_parser)
-        objects = tool_box.get_text_and_object_nodes_in_line(heading, self.heading_text, pos-1)
+        offset = 0
+        if found_heading:
+            # the heading text runs to the end of the line
+            offset = len(self.doc_parser.lines[self.start]) - len(self.heading_text)
+        objects = tool_box.get_text_and_object_nodes_in_line(heading, self.heading_text, pos-1, offset)
         if self.end == self.start:
             self.logger.debug("Header %s has no following section contents", str(self))
             return self.end
@@ -342,6 +397,7 @@ class SectionParse(ParseTool):
         return msg
 
 class TableParse(ParseTool):
+    __slots__ = ()
 
     def __init__(self, doc_parser, start, end, parent_tree_node):
         super().__init__(doc_parser, start, end, parent_tree_node)
@@ -356,19 +412,24 @@ class TableParse(ParseTool):
         matcher = tool_box.get_matcher(MatcherType.table)
         pos = start_pos = self.start
         short_id = f"Table@{start_pos}"
+        classes = self.doc_parser.line_classes
         while pos < self.end + 1:
             for line in self.doc_parser.lines[pos:self.end + 1]:
-                next_elem = tool_box.get_next_element(pos, self.end)
-                if not next_elem:
+                next_pos = classes.find_element(pos, self.end)
+                if next_pos is None:
                     return pos - 1
-                if next_elem['match_type'] != MatcherType.table:
+                if classes.element_type(next_pos) != MatcherType.table:
                     return pos - 1
                 self.logger.debug(self.match_log_format, short_id, str(matcher), line)
                 tr = TableRow(table, pos, pos)
-                for item in line.split('|')[1:-1]:
+                cells = line.split('|')
+                # offset of the first cell, just past the first "|"
+                cell_offset = len(cells[0]) + 1
+                for item in cells[1:-1]:
                     cell = TableCell(tr, pos, pos)
                     content_list = tool_box.get_text_and_object_nodes_in_line(self.tree_node,
-                                                                              item, pos)
+                                                                              item, pos, cell_offset)
+                    cell_offset += len(item) + 1
                     self.logger.debug("cell %s", item)
                     for citem in content_list:
                         citem.move_to_parent(cell)
@@ -378,6 +439,7 @@ class TableParse(ParseTool):
         return self.end
 
 class GreaterElementParse(ParseTool):
+    __slots__ = ('short_id',)
     
     def __init__(self, doc_parser, start, end, parent_tree_node):
         super().__init__(doc_parser, start, end, parent_tree_node)
@@ -434,6 +496,7 @@ class GreaterElementParse(ParseTool):
         return end
 
 class WrappedGEParse(GreaterElementParse):
+    __slots__ = ()
     tree_class = None
 
     def parse(self):
@@ -443,7 +506,7 @@ class WrappedGEParse(GreaterElementParse):
         wrap_start = self.start
         wrap_end = self.end
         elem_start = wrap_start + 1
-        elem_end = wrap_end - 1
+        elem_end = self.get_body_end()
         self.start = elem_start
         self.end = elem_end
         parent_node = self.parent_tree_node
@@ -457,18 +520,21 @@ class WrappedGEParse(GreaterElementParse):
         return self.end
 
 class QuoteParse(WrappedGEParse):
+    __slots__ = ('tree_class',)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.tree_class = QuoteBlock
 
 class CenterParse(WrappedGEParse):
+    __slots__ = ('tree_class',)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.tree_class = CenterBlock
 
 class LesserElementParse(ParseTool):
+    __slots__ = ('text_inside', 'tree_class')
     
     def __init__(self, doc_parser, start, end, parent_tree_node):
         super().__init__(doc_parser, start, end, parent_tree_node)
@@ -479,7 +545,7 @@ class LesserElementParse(ParseTool):
         # all the supported lesser elements
         # are "wrapped' with #+begin_xxx #+end_xxx
         start = self.start + 1
-        end = self.end -1
+        end = self.get_body_end()
         my_lines = []
         for line in self.doc_parser.lines[start:end + 1]:
             my_lines.append(line.lstrip().lstrip(','))
@@ -490,6 +556,7 @@ class LesserElementParse(ParseTool):
         return self.end
     
 class ExampleParse(LesserElementParse):
+    __slots__ = ()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -497,6 +564,7 @@ class ExampleParse(LesserElementParse):
         self.tree_class = ExampleBlock
     
 class CodeParse(LesserElementParse):
+    __slots__ = ()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -504,6 +572,7 @@ class CodeParse(LesserElementParse):
         self.tree_class = CodeBlock
     
 class CommentParse(LesserElementParse):
+    __slots__ = ()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -512,6 +581,7 @@ class CommentParse(LesserElementParse):
 
         
 class ExportParse(LesserElementParse):
+    __slots__ = ()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -519,6 +589,8 @@ class ExportParse(LesserElementParse):
         self.tree_class = ExportBlock
     
 class ListParse(ParseTool):
+    __slots__ = ('list_type', 'start_value', 'margin', 'spaces_per_level', 'regexps',
+                 'list_start', 'list_end', 'list_is_flat', 'short_id')
 
     def __init__(self, doc_parser, start, end, parent_tree_node):
         super().__init__(doc_parser, start, end, parent_tree_node)
@@ -542,17 +614,16 @@ class ListParse(ParseTool):
         self.logger.info(self.match_log_format, self.short_id, "List", "parsing starting")
         # To begin, iterate over the lines looking for the end of the outer list
         # that means two blanks, a heading, or end of section
-        tool_box = ToolBox(self.doc_parser)
-        heading_matcher = tool_box.get_matcher(MatcherType.heading)
+        classes = self.doc_parser.line_classes
         blank_count = 0
         pos += 1
         list_end = self.end
         ends_on_blanks = False
         for line in self.doc_parser.lines[pos:self.end]:
-            if heading_matcher.match_line(line):
+            if classes.is_heading(pos):
                 list_end = pos
                 break
-            if line.strip() == '':
+            if classes.is_blank(pos):
                 blank_count += 1
                 if blank_count >= 2:
                     list_end = pos
@@ -578,7 +649,9 @@ class ListParse(ParseTool):
         pos = self.start
         last_match_pos = None
         for line in self.doc_parser.lines[pos:self.list_end + 1]:
-            match_res = self.list_line_get_type(line)
+            match_res = None
+            if classes.is_list(pos):
+                match_res = self.parse_list_item(line, classes.list_type(pos))
             if match_res:
                 self.logger.info(self.match_log_format, self.short_id, "List", line)
                 match_res['extra_lines'] = []
@@ -718,7 +791,8 @@ class ListParse(ParseTool):
         tool_box = ToolBox(self.doc_parser)
         # this will become bigger once I add parsing for other content such as elements
         content_list = tool_box.get_text_and_object_nodes_in_line(item, record['contents'],
-                                                                  record['line_index'])
+                                                                  record['line_index'],
+                                                                  record['contents_start'])
         if len(record['extra_lines']) > 0:
             xtra = record['extra_lines'] 
             start = xtra[0]
@@ -749,6 +823,9 @@ class ListParse(ParseTool):
         if not match_res:
             return None
         parts = match_res.groupdict()
+        contents_start = match_res.start('contents')
+        if contents_start == -1:
+            contents_start = len(line)
         return {
             'list_type': list_type,
             'lindent': len(parts['lindent']),
@@ -756,10 +833,12 @@ class ListParse(ParseTool):
             'counter_set': parts['counter_set'],  # e.g., [@5], None if absent
             'checkbox': parts['checkbox'],        # e.g., [X], None if absent
             'tag': parts.get('tag'),             # For def lists, None otherwise
-            'contents': parts['contents'] or ''  # Rest of line, empty if None
+            'contents': parts['contents'] or '',  # Rest of line, empty if None
+            'contents_start': contents_start
         }
         
 class ParagraphParse(ParseTool):
+    __slots__ = ()
 
     def __init__(self, doc_parser, start, end, parent_tree_node):
         super().__init__(doc_parser, start, end, parent_tree_node)
@@ -774,10 +853,11 @@ class ParagraphParse(ParseTool):
         end = self.end
         any = False
         breaking = False
+        classes = self.doc_parser.line_classes
         # skip past any leading blank lines
         while pos < self.end + 1 and not any:
             for line in self.doc_parser.lines[pos:end + 1]:
-                if line.strip() == "":
+                if classes.is_blank(pos):
                     BlankLine(self.parent_tree_node, pos, pos)
                     pos += 1
                 else:
@@ -792,7 +872,7 @@ class ParagraphParse(ParseTool):
         last_was_blank = False
         while pos < self.end + 1:
             for line in self.doc_parser.lines[pos:end + 1]:
-                if line.strip() != "":
+                if not classes.is_blank(pos):
                     if last_was_blank:
                         ranges.append([prev_end + 1, pos - 1])
                         prev_end = pos - 1
@@ -813,19 +893,13 @@ class ParagraphParse(ParseTool):
             index += 1
             line_index = r_spec[0]
             for line in self.doc_parser.lines[r_spec[0]:r_spec[1] + 1]:
-                if line.startswith("#+"):
+                if classes.is_keyword(line_index) or classes.is_property(line_index):
                     line_index += 1
                     continue
-                if line.startswith(":"):
-                    tmp = line.split(':')
-                    if len(tmp) > 2:
-                        if line.split()[0].endswith(':'):
-                            line_index += 1
-                            continue
-                if line_index == r_spec[1] and line.strip() == '':
+                if line_index == r_spec[1] and classes.is_blank(line_index):
                     # we do not include blank that ends a paragraph
                     pass
-                elif line_index < r_spec[1] and line.strip() == '':
+                elif line_index < r_spec[1] and classes.is_blank(line_index):
                     # must be more than one blank after paragraph, we honor that
                     BlankLine(para, line_index, line_index)
                 else:
@@ -1019,6 +1093,11 @@ class LineRegexAndEndMatch(LineRegexMatch):
                         groupdict=sr.groupdict(),
                         matched=sr)
         return False
+
+    def find_end_line(self, doc_parser, pos, end):
+        """ Looks up the end line for the block starting at pos in the doc parser's
+        block pairing table rather than scanning forward for it."""
+        return doc_parser.line_classes.find_block_end(pos, end)
     
 class MatchQuote(LineRegexAndEndMatch):
     patterns = [re.compile(r'^\#\+BEGIN_QUOTE', re.IGNORECASE),]
@@ -1123,7 +1202,338 @@ class MatcherType(str, Enum):
 
     def __str__(self):
         return self.value
-    
+
+class LineKind(IntEnum):
+    """ Per line classification codes stored in LineClasses.kinds """
+
+    text = 0
+    blank = 1
+    keyword = 2
+    property = 3
+    heading = 4
+    table = 5
+    alist = 6
+    block_begin = 7
+    block_end = 8
+
+class InlineSpan(typing.NamedTuple):
+    """ One object found by InlineTokenizer. The start and end are the offsets of the
+    first and last characters of the object markup, inclusive. The contents are the
+    half open range content_start to content_end, which for a link is the description,
+    or the target if there is no description. The target is only set for links."""
+
+    match_type: MatcherType
+    start: int
+    end: int
+    content_start: int
+    content_end: int
+    target: typing.Optional[str] = None
+
+class InlineTokenizer:
+    """ Finds the org objects in a line of text in a single left to right scan. The
+    scan jumps from one possible markup character to the next, and at each one tries
+    only the object that can start with that character. When an object is found the
+    scan resumes after it, so the first object to start wins any overlap. The contents
+    of objects in nesting_types can be tokenized again to find objects nested inside
+    them. Lines with no markup characters at all are rejected by a single search.
+
+    The object rules are the same ones the object matchers implement, an emphasis object
+    runs to the next occurance of its marker character, with at least one character between.
+    """
+    markup_re = re.compile(r'[*/_+=~<\[]')
+    emphasis_types = {'*': MatcherType.bold_object,
+                      '/': MatcherType.italic_object,
+                      '+': MatcherType.linethrough_object,
+                      '=': MatcherType.verbatim_object,
+                      '~': MatcherType.inlinecode_object}
+    nesting_types = (MatcherType.bold_object, MatcherType.italic_object,
+                     MatcherType.underlined_object, MatcherType.linethrough_object)
+
+    def __init__(self):
+        # when more than one underline pattern matches, the last one wins
+        self.underline_patterns = list(reversed(UnderlinedObjectMatcher.patterns))
+        self.link_pattern = InternalLinkObjectMatcher.patterns[0]
+
+    def tokenize(self, line, start=0, stop=None):
+        if stop is None:
+            stop = len(line)
+        spans = []
+        res = self.markup_re.search(line, start, stop)
+        while res:
+            pos = res.start()
+            span = self.match_at(line, pos, stop)
+            if span is not None:
+                spans.append(span)
+                pos = span.end
+            res = self.markup_re.search(line, pos + 1, stop)
+        return spans
+
+    def match_at(self, line, pos, stop):
+        char = line[pos]
+        if char in self.emphasis_types:
+            close = line.find(char, pos + 2, stop)
+            if close == -1:
+                return None
+            return InlineSpan(self.emphasis_types[char], pos, close, pos + 1, close)
+        if char == '_':
+            for pattern in self.underline_patterns:
+                res = pattern.match(line, pos, stop)
+                if res:
+                    return InlineSpan(MatcherType.underlined_object, pos, res.end() - 1,
+                                      res.start('text'), res.end('text'))
+            return None
+        if char == '<':
+            if not line.startswith('<<', pos):
+                return None
+            close = line.find('>>', pos + 3, stop)
+            if close == -1:
+                return None
+            return InlineSpan(MatcherType.target_object, pos, close + 1, pos + 2, close)
+        if not line.startswith('[[', pos):
+            return None
+        res = self.link_pattern.match(line, pos, stop)
+        if not res or res.group('pathreg') is None:
+            return None
+        if res.group('description') is not None:
+            content = res.span('description')
+        else:
+            content = res.span('pathreg')
+        return InlineSpan(MatcherType.internal_link_object, pos, res.end() - 1,
+                          content[0], content[1], res.group('pathreg'))
+
+class SectionSpan(typing.NamedTuple):
+    """ One level 1 section boundary as found by LineClasses.split_sections. The
+    level and heading_text are None when the section does not start with a heading,
+    as can happen with the zeroth section."""
+
+    start: int
+    end: int
+    level: typing.Optional[int]
+    heading_text: typing.Optional[str]
+
+class LineClasses:
+    """ Classifies every line of a document exactly once so that the parse tools
+    can find element starts by lookup instead of re-running every matcher
+    against every line each time a range is searched. The classification
+    follows the same matcher precedence as ToolBox.get_next_element always
+    has, heading first, then table, list and the blocks.
+
+    The per line data is kept in parallel arrays indexed by line number:
+    kinds holds a LineKind code, levels holds the number of stars for a heading
+    or the indent for tables and lists, and subtypes holds an index into
+    list_types for list lines or into block_types for block begin and end lines.
+    block_ends holds, for every block begin line, the line number of the end
+    line that closes it, or -1 if it is never closed.
+    """
+    list_types = (ListType.ordered_list, ListType.def_list, ListType.unordered_list)
+    block_types = (MatcherType.quote_block, MatcherType.center_block,
+                   MatcherType.example_block, MatcherType.code_block,
+                   MatcherType.comment_block, MatcherType.export_block)
+    block_names = ("QUOTE", "CENTER", "EXAMPLE", "SRC", "COMMENT", "EXPORT")
+    # quote and center can contain other elements, including blocks
+    # of their own kind, the rest have verbatim contents
+    nesting_blocks = (0, 1)
+    kind_to_type = {LineKind.heading: MatcherType.heading,
+                    LineKind.table: MatcherType.table,
+                    LineKind.alist: MatcherType.alist}
+
+    def __init__(self, lines):
+        self.lines = lines
+        count = len(lines)
+        self.kinds = array('B', bytes(count))
+        self.levels = array('i', bytes(4 * count))
+        self.subtypes = array('B', bytes(count))
+        # line numbers of "#+" lines that are not element starts, these
+        # become the keywords of the next element if no blank line intervenes
+        self.keyword_lines = []
+        list_matcher = MatchList()
+        list_regexps = [list_matcher.get_compiled_regex(lt) for lt in self.list_types]
+        for pos, line in enumerate(lines):
+            self.classify(pos, line, list_regexps)
+        # next_element[i] is the first element start line at or after line i,
+        # or the line count if there is none
+        self.next_element = array('i', bytes(4 * (count + 1)))
+        next_pos = count
+        self.next_element[count] = count
+        for pos in range(count - 1, -1, -1):
+            if self.kinds[pos] in (LineKind.heading, LineKind.table,
+                                   LineKind.alist, LineKind.block_begin):
+                next_pos = pos
+            self.next_element[pos] = next_pos
+        # prev_blank[i] is the last blank line before line i, or -1
+        self.prev_blank = array('i', bytes(4 * (count + 1)))
+        last_blank = -1
+        for pos in range(count):
+            self.prev_blank[pos] = last_blank
+            if self.kinds[pos] == LineKind.blank:
+                last_blank = pos
+        self.prev_blank[count] = last_blank
+        self.block_ends = array('i', [-1]) * count
+        self.pair_blocks()
+
+    def pair_blocks(self):
+        """ Matches every block begin line with its end line in one pass. Blocks that
+        can nest are paired with a stack per block kind. Blocks with verbatim contents
+        end at the first end line of their kind, and nothing inside them is paired, so
+        a #+BEGIN_SRC line inside an example block is just text. A verbatim block that
+        is never closed is left unpaired and the lines after it are paired normally.
+        """
+        ends_by_code = defaultdict(list)
+        for pos in range(len(self.lines)):
+            if self.kinds[pos] == LineKind.block_end:
+                ends_by_code[self.subtypes[pos]].append(pos)
+        stacks = defaultdict(list)
+        pos = 0
+        while pos < len(self.lines):
+            kind = self.kinds[pos]
+            code = self.subtypes[pos]
+            if kind == LineKind.block_begin:
+                if code in self.nesting_blocks:
+                    stacks[code].append(pos)
+                else:
+                    ends = ends_by_code[code]
+                    index = bisect_left(ends, pos)
+                    if index < len(ends):
+                        self.block_ends[pos] = ends[index]
+                        pos = ends[index]
+            elif kind == LineKind.block_end and code in self.nesting_blocks:
+                if stacks[code]:
+                    self.block_ends[stacks[code].pop()] = pos
+            pos += 1
+
+    def classify(self, pos, line, list_regexps):
+        first = line[:1]
+        if first == '*':
+            # MatchHeading accepts any line starting with a star
+            self.kinds[pos] = LineKind.heading
+            self.levels[pos] = len(line) - len(line.lstrip('*'))
+            return
+        stripped = line.lstrip(' \t')
+        if stripped[:1] == '|' or stripped[:2] == '+-':
+            self.kinds[pos] = LineKind.table
+            self.levels[pos] = len(line) - len(stripped)
+            return
+        lead = line.lstrip()[:1]
+        if lead == '':
+            self.kinds[pos] = LineKind.blank
+            return
+        if lead in '-+*' or lead.isdigit():
+            for code, regex in enumerate(list_regexps):
+                match_res = regex.match(line)
+                if match_res:
+                    self.kinds[pos] = LineKind.alist
+                    self.levels[pos] = len(match_res.group('lindent'))
+                    self.subtypes[pos] = code
+                    return
+        if line.startswith("#+"):
+            upper = line[:16].upper()
+            if upper.startswith("#+BEGIN_") or upper.startswith("#+END_"):
+                is_begin = upper.startswith("#+BEGIN_")
+                name = upper[8:] if is_begin else upper[6:]
+                for code, block_name in enumerate(self.block_names):
+                    if name.startswith(block_name):
+                        self.subtypes[pos] = code
+                        if is_begin:
+                            self.kinds[pos] = LineKind.block_begin
+                            return
+                        self.kinds[pos] = LineKind.block_end
+                        break
+            if self.kinds[pos] != LineKind.block_end:
+                self.kinds[pos] = LineKind.keyword
+            self.keyword_lines.append(pos)
+            return
+        if first == ':':
+            # same test ParagraphParse uses to drop drawer lines
+            if len(line.split(':')) > 2 and line.split()[0].endswith(':'):
+                self.kinds[pos] = LineKind.property
+                return
+        self.kinds[pos] = LineKind.text
+
+    def split_sections(self, offset=0):
+        """ Walks the lines from offset once and returns a SectionSpan for each section,
+        the first one starting at offset and each following one at a heading line.
+        Headings inside the body of a closed verbatim block such as #+BEGIN_SRC
+        are contents, not section starts."""
+        count = len(self.lines)
+        starts = [offset]
+        pos = offset
+        while pos < count:
+            kind = self.kinds[pos]
+            if kind == LineKind.heading and pos != offset:
+                starts.append(pos)
+            elif (kind == LineKind.block_begin and self.block_ends[pos] > pos
+                  and self.subtypes[pos] not in self.nesting_blocks):
+                pos = self.block_ends[pos]
+            pos += 1
+        spans = []
+        for index, start in enumerate(starts):
+            if index == len(starts) - 1:
+                end = count - 1
+            else:
+                end = starts[index + 1] - 1
+            level = heading_text = None
+            if start < count and self.kinds[start] == LineKind.heading:
+                level = self.levels[start]
+                heading_text = self.lines[start][level:].lstrip(' \t')
+            spans.append(SectionSpan(start, end, level, heading_text))
+        return spans
+
+    def is_blank(self, pos):
+        return self.kinds[pos] == LineKind.blank
+
+    def is_heading(self, pos):
+        return self.kinds[pos] == LineKind.heading
+
+    def is_list(self, pos):
+        return self.kinds[pos] == LineKind.alist
+
+    def is_keyword(self, pos):
+        # any "#+" line, including the block wrappers
+        return self.kinds[pos] in (LineKind.keyword, LineKind.block_begin, LineKind.block_end)
+
+    def is_property(self, pos):
+        return self.kinds[pos] == LineKind.property
+
+    def find_element(self, start, end):
+        """ Returns the line number of the first element start in the range start to end
+        inclusive, or None if there is none."""
+        if start >= len(self.lines):
+            return None
+        pos = self.next_element[start]
+        if pos > end or pos >= len(self.lines):
+            return None
+        return pos
+
+    def element_type(self, pos):
+        kind = self.kinds[pos]
+        if kind == LineKind.block_begin:
+            return self.block_types[self.subtypes[pos]]
+        return self.kind_to_type.get(kind, None)
+
+    def list_type(self, pos):
+        if self.kinds[pos] != LineKind.alist:
+            return None
+        return self.list_types[self.subtypes[pos]]
+
+    def find_block_end(self, pos, end):
+        """ Returns the line number of the end line paired with the block that
+        begins on line pos, or None if it is unpaired or lies beyond end."""
+        if self.kinds[pos] != LineKind.block_begin:
+            return None
+        pair = self.block_ends[pos]
+        if pair < 0 or pair > end:
+            return None
+        return pair
+
+    def keywords_before(self, start, pos):
+        """ Returns the keyword lines that apply to the element at line pos when the
+        search for it started at line start. Keywords only apply when there
+        are no blank lines between them and the element."""
+        first = max(start, self.prev_blank[pos] + 1)
+        low = bisect_left(self.keyword_lines, first)
+        high = bisect_left(self.keyword_lines, pos)
+        return [self.lines[index] for index in self.keyword_lines[low:high]]
+
 class ToolBox:
     greater_matchers = {MatcherType.heading: MatchHeading(),
                         MatcherType.table:MatchTable(),
@@ -1149,6 +1559,8 @@ class ToolBox:
                        MatcherType.internal_link_object:InternalLinkObjectMatcher(),
                        #MatcherType.image_object:ImageObjectMatcher(),
                        }
+    inline_tokenizer = InlineTokenizer()
+
     @classmethod
     def get_matcher_dict(cls):
         res = dict(cls.greater_matchers)
@@ -1166,191 +1578,132 @@ class ToolBox:
         
     def get_next_element(self, start, end):
         """ See https://orgmode.org/worg/org-syntax.html#Elements. Some
-        things covered elsewhere such as the zeroth section, which is detected by the initial parser."""
+        things covered elsewhere such as the zeroth section, which is detected by the initial parser.
+        The element starts come from the doc parser's LineClasses, so the only regex run here is the
+        one that collects the match details for the line that was found."""
 
-        
-        element_matchers = dict(self.greater_matchers)
-        element_matchers.update(self.lesser_matchers)
-        pos = start
+        classes = self.doc_parser.line_classes
+        pos = classes.find_element(start, end)
+        if pos is None:
+            return None
         logger = logging.getLogger('roam2doc.parser')
-        pending_keywords = []
-        for line in self.doc_parser.lines[start:end+1]:
-            # greater elements
-            for match_type, matcher in element_matchers.items():
-                match_res = matcher.match_line(line)
-                if match_res:
-                    logger.debug("matched %s at line %d", match_type, pos)
-                    parse_tool = matcher.get_parse_tool()
-                    matched = match_res['matched']
-                    res = dict(match_type=match_type, pos=pos,
-                               parse_tool=parse_tool,
-                               string=matched.string,
-                               match_line=pos,
-                               start_char=match_res['start'],
-                               end_char=match_res['end'] - 1,
-                               keywords=pending_keywords,
-                               matched_contents=matched.groupdict())
-                    if hasattr(matcher, 'match_end_line') and callable(getattr(matcher, 'match_end_line')):
-                        subpos = pos + 1
-                        for subline in self.doc_parser.lines[subpos:end+1]:
-                            end_matched = matcher.match_end_line(subline)
-                            if end_matched:
-                                ressub = dict(match_type=match_type,
-                                              pos=subpos,
-                                              parse_tool=parse_tool,
-                                              match_line=subpos,
-                                              start_char=end_matched['start'],
-                                              end_char=end_matched['end'] - 1,
-                                              end_matched_contents=end_matched['groupdict'])
-                                res['end_match'] = ressub
-                                break
-                            subpos += 1
-                    return res
-            # line unmatched, see if it right format for a keyword
-            if line.strip() == '':
-                # keywords only apply if no blank lines before element
-                pending_keywords = []
-            elif line.startswith("#+"):
-                pending_keywords.append(line)
-            pos += 1
-        return None
-
-    def get_text_and_object_nodes_in_line(self, tree_node, line, line_index):
-        blocks_by_offset = {}
-
-        matches_per_type = {}
-        for match_type, matcher in self.object_matchers.items():
-            mres = matcher.match_text(line)
-            for m in mres:
-                m['source_line'] = line
-                m['line_index'] = line_index
-            matches_per_type[match_type] = mres
-
-        for match_type in self.object_matchers:
-            for mitem in matches_per_type[match_type]:
-                mitem['matcher_type'] = match_type
-                blocks_by_offset[mitem['start']] = mitem
+        match_type = classes.element_type(pos)
+        matcher = self.get_matcher(match_type)
+        match_res = matcher.match_line(self.doc_parser.lines[pos])
+        logger.debug("matched %s at line %d", match_type, pos)
+        parse_tool = matcher.get_parse_tool()
+        matched = match_res['matched']
+        res = dict(match_type=match_type, pos=pos,
+                   parse_tool=parse_tool,
+                   string=matched.string,
+                   match_line=pos,
+                   start_char=match_res['start'],
+                   end_char=match_res['end'] - 1,
+                   keywords=classes.keywords_before(start, pos),
+                   matched_contents=matched.groupdict())
+        if hasattr(matcher, 'find_end_line') and callable(getattr(matcher, 'find_end_line')):
+            subpos = matcher.find_end_line(self.doc_parser, pos, end)
+            if subpos is not None:
+                end_matched = matcher.match_end_line(self.doc_parser.lines[subpos])
+                ressub = dict(match_type=match_type,
+                              pos=subpos,
+                              parse_tool=parse_tool,
+                              match_line=subpos,
+                              start_char=end_matched['start'],
+                              end_char=end_matched['end'] - 1,
+                              end_matched_contents=end_matched['groupdict'])
+                res['end_match'] = ressub
+        return res
 
-        # find overlaps. objects can contain other objects, e.g. <<*bold*>>
+    def get_text_and_object_nodes_in_line(self, tree_node, line, line_index, offset=0):
+        """ Converts the text in line into Text and object nodes added to tree_node.
+        The line may be just part of the source line, such as a table cell, in which
+        case offset is where it starts in the source line so that the node positions
+        are correct."""
+        spans = self.inline_tokenizer.tokenize(line)
+        if len(spans) == 0:
+            return [Text(tree_node, line_index, line_index, line, offset, offset + len(line) - 1),]
+        return self.add_span_nodes(tree_node, line, 0, len(line), spans, line_index, offset)
+
+    def add_span_nodes(self, tree_node, line, start, stop, spans, line_index, offset):
         items = []
-        tmp = list(blocks_by_offset.keys())
-        if len(tmp) == 0:
-            items.append(Text(tree_node, line_index, line_index, line))
-            return items
-        tmp.sort()
-        pos = tmp[0]
-        by_start = {}
-        block_id_pos = 0
-        last_block = None
-        while block_id_pos < len(tmp):
-            pos = tmp[block_id_pos]
-            block = blocks_by_offset[pos]
-            if last_block and last_block['end'] > block['end']:
-                block_id_pos += 1
-                continue
-            self.fold_inner(pos, blocks_by_offset)
-            by_start[pos] = block
-            block_id_pos += 1
-            last_block = block
-        order = sorted(by_start.keys())
-        last_end = -1
-        for pos,item in by_start.items():
-            if pos > last_end + 1:
-                text_chunk = line[last_end + 1:pos].strip()
-                if text_chunk:
-                    items.append(Text(tree_node, line_index, line_index, text_chunk,
-                                      last_end + 1, pos))
-            items.append(self.do_object_parts(item, tree_node, line_index))
-            last_end = item['end']
-
-        if last_end  < len(line):
-            text_chunk = line[last_end:].strip()
-            if text_chunk:
-                Text(tree_node, line_index, line_index, text_chunk, last_end, len(line))
+        last_end = start
+        for span in spans:
+            if span.start > last_end:
+                items.extend(self.add_text_chunk(tree_node, line, last_end, span.start,
+                                                 line_index, offset))
+            items.append(self.do_object_parts(span, tree_node, line, line_index, offset))
+            last_end = span.end + 1
+        if last_end < stop:
+            items.extend(self.add_text_chunk(tree_node, line, last_end, stop, line_index, offset))
         return items
 
-    def fold_inner(self, pos, blocks_by_offset):
-        block = blocks_by_offset[pos]
-        start = block['start']
-        inner = []
-        next_pos = start + 1
-        inner_block = blocks_by_offset.get(next_pos, None)
-        if inner_block:
-            inner.append(inner_block)
-            self.fold_inner(next_pos, blocks_by_offset)
-            block['inner_objects'] = inner
-        
-    def do_object_parts(self, item, tree_node, line_index):
+    def add_text_chunk(self, tree_node, line, start, stop, line_index, offset):
+        chunk = line[start:stop]
+        text_chunk = chunk.strip()
+        if not text_chunk:
+            return []
+        chunk_start = offset + start + len(chunk) - len(chunk.lstrip())
+        return [Text(tree_node, line_index, line_index, text_chunk,
+                     chunk_start, chunk_start + len(text_chunk) - 1),]
+
+    def do_object_parts(self, span, tree_node, line, line_index, offset):
         simple_text = None
-        if "inner_objects" not in item:
-            rejects = [MatcherType.internal_link_object,]
-            if item['matcher_type'] not in rejects :
-                simple_text = item['matched'].groupdict()['text']
-        tree_item = self.add_object_item(tree_node, item, line_index,
-                                         item['matched'].start(),
-                                         item['matched'].end() -1,
-                                         simple_text)
-        if "inner_objects" not in item:
-            return tree_item
-        for in_item in item['inner_objects']:
-            self.do_object_parts(in_item, tree_item, line_index)
+        inner = []
+        if span.match_type != MatcherType.internal_link_object:
+            if span.match_type in self.inline_tokenizer.nesting_types:
+                inner = self.inline_tokenizer.tokenize(line, span.content_start, span.content_end)
+            if len(inner) == 0:
+                simple_text = line[span.content_start:span.content_end]
+        tree_item = self.add_object_item(tree_node, span, line, line_index,
+                                         offset + span.start,
+                                         offset + span.end,
+                                         simple_text, offset)
+        if len(inner) > 0:
+            self.add_span_nodes(tree_item, line, span.content_start, span.content_end,
+                                inner, line_index, offset)
         return tree_item
         
-    def add_object_item(self, tree_node, item, line_index, start_pos, end_pos, simple_text):
-        if item['matcher_type'] == MatcherType.bold_object:
+    def add_object_item(self, tree_node, span, line, line_index, start_pos, end_pos, simple_text, offset=0):
+        match_type = span.match_type
+        if match_type == MatcherType.bold_object:
             tree_item = BoldText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.italic_object:
+        elif match_type == MatcherType.italic_object:
             tree_item = ItalicText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.underlined_object:
+        elif match_type == MatcherType.underlined_object:
             tree_item = UnderlinedText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.linethrough_object:
+        elif match_type == MatcherType.linethrough_object:
             tree_item = LinethroughText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.inlinecode_object:
+        elif match_type == MatcherType.inlinecode_object:
             tree_item = InlineCodeText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.verbatim_object:
+        elif match_type == MatcherType.verbatim_object:
             tree_item = VerbatimText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.target_object:
+        elif match_type == MatcherType.target_object:
             tree_item = TargetText(tree_node, line_index, start_pos, end_pos, simple_text)
-        elif item['matcher_type'] == MatcherType.internal_link_object:
-            target_text = item['matched'].groupdict()['pathreg']
-            desc = item['matched'].groupdict()['description']
-            if desc is None:
-                desc = target_text
+        elif match_type == MatcherType.internal_link_object:
+            target_text = span.target
+            # if there is no description, the target is displayed
+            desc = line[span.content_start:span.content_end]
+            desc_offset = offset + span.content_start
             # have to figure out what kind of link it is
             if "//" in target_text:
                 # some kind of uri
                 tree_item = Link(tree_node, line_index, start_pos, end_pos, target_text, None)
-                items = self.get_text_and_object_nodes_in_line(tree_item, desc, line_index)
+                items = self.get_text_and_object_nodes_in_line(tree_item, desc, line_index, desc_offset)
             else:
                 # Try to make a file path from it and
                 # see if there is a file there, which means
                 # that it is an image file. If it is not
                 # an image file then the user is out of luck
                 tree_item = None
-                prefix = 'file:'
-                if target_text.lower().startswith(prefix):
-                    file_part = target_text[len(prefix):]
-                else:
-                    file_part = target_text
-                doc_path = Path(self.doc_parser.root.source).parent
-                if file_part.startswith('./'):
-                    path = Path(doc_path, file_part[2:])
-                else:
-                    path = Path(doc_path, file_part)
-                path.resolve()
-                is_image = False
-                if path.exists():
-                    proc = subprocess.Popen(['file', str(path)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    result,error = proc.communicate()
-                    if "image" in str(result):
-                        is_image = True
-                if is_image:
+                path = link_target_path(target_text, self.doc_parser.root.source)
+                if is_image_file(path):
                     tree_item = Image(tree_node, line_index, line_index, str(path), desc)
                 else:
                     # If we can't make it into an image, just assume
                     # it is an internal link, give special treatment
                     tree_item = InternalLink(tree_node, line_index, start_pos, end_pos,
                                              target_text, None)
-                    items = self.get_text_and_object_nodes_in_line(tree_item, desc, line_index)
+                    items = self.get_text_and_object_nodes_in_line(tree_item, desc, line_index, desc_offset)
         return tree_item
         
@@ -58,6 +58,9 @@ def set_levels(handler_names, additions=None, default_level='error'): # pragma:
     log_loggers['roam2doc.parser'] = default_log
     log_loggers['roam2doc.tree'] = default_log
     log_loggers['roam2doc.io'] = default_log
+    log_loggers['roam2doc.cache'] = default_log
+    log_loggers['roam2doc.watch'] = default_log
+    log_loggers['roam2doc.images'] = default_log
     log_loggers['test_code'] = default_log
     if additions:
         for add in additions:
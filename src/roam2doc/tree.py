@@ -1,4 +1,5 @@
 import re
+import io
 import getpass
 import json
 import logging
@@ -17,13 +18,72 @@ class Root:
         self.link_targets = {}
         self.css_classes = {}
         self.grokify = False
+        # Every Heading in the tree by its original text, and by that text
+        # normalized, filled in as headings are created so that a link by
+        # heading text does not have to search the tree
+        self.headings_by_text = defaultdict(list)
+        self.headings_by_normal_text = defaultdict(list)
+        self.logger = logging.getLogger('roam2doc.tree')
+        # a LinkGraph made by resolve_links, None when it needs to be made
+        # again because links or targets have been added or removed
+        self.link_graph = None
+        # made from the link graph by prepare_grokify, along with the
+        # cross reference records
+        self.grok_target_ids = None
+        self.xref_records = None
+        self.grok_graph = None
+        # Every node and branch in the tree by node id, filled in as they are
+        # created. The index by class, each class to a dict by node id, costs
+        # as much again, so it is only built by the first get_nodes call and
+        # kept up to date from then on
+        self.nodes_by_id = {}
+        self.nodes_by_class = None
 
     def new_node_id(self):
         self.node_id += 1
         return self.node_id
 
+    def add_to_index(self, node):
+        self.nodes_by_id[node.node_id] = node
+        if self.nodes_by_class is not None:
+            self.nodes_by_class[node.__class__][node.node_id] = node
+
+    def remove_from_index(self, node):
+        if self.nodes_by_id.get(node.node_id) is node:
+            del self.nodes_by_id[node.node_id]
+        if self.nodes_by_class is None:
+            return
+        by_id = self.nodes_by_class.get(node.__class__)
+        if by_id is not None and by_id.get(node.node_id) is node:
+            del by_id[node.node_id]
+
+    def make_class_index(self):
+        self.nodes_by_class = defaultdict(dict)
+        for node_id, node in self.nodes_by_id.items():
+            self.nodes_by_class[node.__class__][node_id] = node
+
+    def get_node(self, node_id):
+        return self.nodes_by_id.get(node_id)
+
+    def get_nodes(self, classes):
+        """ Returns a list of the nodes in the tree that are instances of classes, a
+        class or a tuple of them as for isinstance, in node id order."""
+        if self.nodes_by_class is None:
+            self.make_class_index()
+        res = []
+        for cls, by_id in self.nodes_by_class.items():
+            if issubclass(cls, classes):
+                res.extend(by_id.values())
+        res.sort(key=lambda node: node.node_id)
+        return res
+
+    def walk(self, classes=None, prune=None):
+        """ Iterates over the tree, see walk_nodes."""
+        return walk_nodes(self.trunk, classes, prune)
+
     def add_link_target(self, node, target_id):
         self.link_targets[target_id] = LinkTarget(node, target_id)
+        self.link_graph = None
 
     def get_link_target(self, target_id):
         if target_id in self.link_targets:
@@ -43,20 +103,141 @@ class Root:
         self.link_targets[target_id] = new_target
         return {'link_target': new_target, 'node': new_target.target_node}
 
-    def find_heading_match(self, text, level=None):
-        if not level:
-            level = self.trunk
-        # breadth first
-        for kid in level.children:
-            if isinstance(kid, Section):
-                if kid.heading.original_text == text:
-                    return kid.heading
-        for kid in level.children:
-            if not hasattr(kid, 'children'):
+    def drop_link_targets(self, removed_ids):
+        """ Drops the link targets for nodes that have been removed from the tree, removed_ids
+        being the python ids of the removed nodes, so that the links get resolved again
+        against what is left."""
+        for target_id, link_target in list(self.link_targets.items()):
+            if id(link_target.target_node) in removed_ids:
+                del self.link_targets[target_id]
+        self.link_graph = None
+
+    def resolve_links(self):
+        """ Resolves every internal link in the tree, in the order that they are rendered,
+        noting each one as a reference on its link target, and returns the LinkGraph of
+        the results. Resolving a link by heading text adds a link target for the heading,
+        so that it shows up in the json and the cross reference."""
+        graph = LinkGraph()
+        for link_target in self.link_targets.values():
+            link_target.clear_references()
+        for node in walk_nodes(self.trunk):
+            if not isinstance(node, InternalLink):
                 continue
-            found = self.find_heading_match(text, kid)
-            if found:
-                return found
+            res = self.get_link_target(node.target_text)
+            node.target_node = res['node']
+            if res['link_target']:
+                res['link_target'].note_reference(node)
+            graph.add_link(node, node.target_node)
+        if graph.broken:
+            self.logger.info("%d of %d internal links have no target",
+                             len(graph.broken), len(graph.target_by_link))
+        self.link_graph = graph
+        return graph
+
+    def get_link_graph(self):
+        if self.link_graph is None:
+            self.resolve_links()
+        return self.link_graph
+
+    def prepare_grokify(self):
+        """ Works out, once for the current link graph, the node ids of the link targets that
+        get an xref tag in grokified output and the records for the cross reference, so
+        that rendering a node doesn't have to look through all the link targets."""
+        graph = self.get_link_graph()
+        self.grok_target_ids = set()
+        self.xref_records = []
+        for link_target in self.link_targets.values():
+            self.grok_target_ids.add(link_target.target_node.node_id)
+            if link_target.references:
+                self.xref_records.append(dict(target=link_target.target_node,
+                                              references=list(link_target.references)))
+        self.grok_graph = graph
+
+    def get_grok_target_ids(self):
+        if self.grok_graph is None or self.grok_graph is not self.get_link_graph():
+            self.prepare_grokify()
+        return self.grok_target_ids
+
+    def get_broken_link_report(self):
+        """ Returns a list of dicts, one for each internal link that has no target, saying
+        what it was looking for and where it is."""
+        report = []
+        for link in self.get_link_graph().broken:
+            source_data = link.get_source_data()
+            report.append(dict(target_text=link.target_text, node_id=link.node_id,
+                               source_file=source_data['source_file'],
+                               source_line=source_data['source_line']))
+        return report
+
+    def add_heading(self, heading):
+        self.headings_by_text[heading.original_text].append(heading)
+        self.headings_by_normal_text[normalize_heading_text(heading.original_text)].append(heading)
+
+    def remove_heading(self, heading):
+        for index, key in ((self.headings_by_text, heading.original_text),
+                           (self.headings_by_normal_text, normalize_heading_text(heading.original_text))):
+            headings = index.get(key, [])
+            if heading in headings:
+                headings.remove(heading)
+            if not headings:
+                index.pop(key, None)
+
+    def find_heading_match(self, text, level=None, normalized=False):
+        """ Returns the heading whose original text is text, or with normalized set whose
+        text matches ignoring case and spacing. When more than one heading matches, the
+        one that a search of the tree from level would find first wins, and the others
+        are logged as ambiguous. A level other than the trunk is searched directly.
+        """
+        if level is not None and level is not self.trunk:
+            return self.search_heading_match(text, level)
+        if normalized:
+            headings = self.headings_by_normal_text.get(normalize_heading_text(text), [])
+        else:
+            headings = self.headings_by_text.get(text, [])
+        if len(headings) == 0:
+            return None
+        if len(headings) == 1:
+            return headings[0]
+        ranked = sorted(headings, key=self.heading_search_rank)
+        self.logger.debug("heading text '%s' is ambiguous, using %s over %s", text,
+                          ranked[0], ", ".join(str(h) for h in ranked[1:]))
+        return ranked[0]
+
+    def heading_search_rank(self, heading):
+        # The search checks the sections that are direct children of a level
+        # before going down into each child in turn, so each step of the path
+        # from the trunk is (1, index) and the last one, where the section
+        # itself is checked, is (0, index)
+        rank = []
+        node = heading.parent
+        last = 0
+        while node is not self.trunk:
+            parent = node.parent
+            rank.append((last, parent.children.index(node)))
+            last = 1
+            node = parent
+        rank.reverse()
+        return rank
+
+    def find_heading_ambiguities(self):
+        """ Returns a dict of the heading texts that more than one heading has, each to
+        the list of those headings, the one that a link would go to first."""
+        res = {}
+        for text, headings in self.headings_by_text.items():
+            if len(headings) > 1:
+                res[text] = sorted(headings, key=self.heading_search_rank)
+        return res
+
+    def search_heading_match(self, text, level):
+        # breadth first at each level, then down into each child in turn
+        stack = [level]
+        while stack:
+            level = stack.pop()
+            for kid in level.children:
+                if isinstance(kid, Section):
+                    if kid.heading.original_text == text:
+                        return kid.heading
+            stack.extend(kid for kid in reversed(level.children) if hasattr(kid, 'children'))
         return None
         
     def to_json_dict(self):
@@ -65,88 +246,121 @@ class Root:
                    trunk=self.trunk.to_json_dict()))
         return res
 
+    def coalesce(self):
+        """ Runs coalesce_nodes over the whole tree, see there."""
+        removed = coalesce_nodes(self.trunk)
+        self.link_graph = None
+        self.logger.info("coalesced %d nodes", removed)
+        return removed
+
     def add_css_class(self, class_spec):
         self.css_classes[class_spec['name']] = class_spec
         
     def to_latex(self, wrap=True, do_index=True, title=None, author=None, grokify=False):
+        out = io.StringIO()
+        self.write_latex(out, wrap=wrap, do_index=do_index, title=title, author=author, grokify=grokify)
+        return out.getvalue()
+
+    def write_latex(self, out, wrap=True, do_index=True, title=None, author=None, grokify=False):
+        """ Writes the latex to the file like object out as it is produced, rather than
+        building it in memory. The cross reference goes last because it lists the
+        references noted while the body is written."""
         self.grokify = grokify
+        if grokify:
+            self.prepare_grokify()
+        else:
+            self.get_link_graph()
         if title is None:
             title = tex_escape(f"roam2doc parse of {self.source}")
         if author is None:
             author = tex_escape(getpass.getuser())
-        lines = []
-        
-        doc_lines = self.trunk.to_latex()
+        writer = LineWriter(out)
         if wrap:
-            lines.append('% Intended LaTeX compiler: pdflatex')
-            lines.append(r'\documentclass[11pt]{article}')
-            lines.append(r'\usepackage[utf8]{inputenc}')
-            lines.append(r'\usepackage[T1]{fontenc}')
-            lines.append(r'\usepackage{graphicx}')
-            lines.append(r'\usepackage{longtable}')
-            lines.append(r'\usepackage{wrapfig}')
-            lines.append(r'\usepackage{rotating}')
-            lines.append(r'\usepackage[normalem]{ulem}')
-            lines.append(r'\usepackage{amsmath}')
-            lines.append(r'\usepackage{amssymb}')
-            lines.append(r'\usepackage{capt-of}')
-            lines.append(r'\usepackage{imakeidx}') 
-            lines.append(r'\makeindex[intoc]') 
-            lines.append(r'\usepackage{times}')  # Use Times font
-            lines.append(r'\usepackage{hyperref}')
-            lines.append(r'\hypersetup{')
-            lines.append(r'  colorlinks=true')
-            lines.append(r'}')
-            lines.append(r'\author{' + f"{author}" + '}')
-            lines.append(r'\date{\today}')
-            lines.append(r'\title{' + f"{title}" + '}')
-            lines.append(r'\setcounter{secnumdepth}{6}')
-            lines.append(r'\setlength{\parindent}{0pt}')
-            lines.append(r'\setcounter{tocdepth}{6}')
-            lines.append(r'\begin{document}')
-            lines.append(r'\maketitle')
-            lines.append(r'\tableofcontents')
-            lines.append(r'\clearpage')
-            lines.extend(doc_lines)
+            writer.write_line('% Intended LaTeX compiler: pdflatex')
+            writer.write_line(r'\documentclass[11pt]{article}')
+            writer.write_line(r'\usepackage[utf8]{inputenc}')
+            writer.write_line(r'\usepackage[T1]{fontenc}')
+            writer.write_line(r'\usepackage{graphicx}')
+            writer.write_line(r'\usepackage{longtable}')
+            writer.write_line(r'\usepackage{wrapfig}')
+            writer.write_line(r'\usepackage{rotating}')
+            writer.write_line(r'\usepackage[normalem]{ulem}')
+            writer.write_line(r'\usepackage{amsmath}')
+            writer.write_line(r'\usepackage{amssymb}')
+            writer.write_line(r'\usepackage{capt-of}')
+            writer.write_line(r'\usepackage{imakeidx}') 
+            writer.write_line(r'\makeindex[intoc]') 
+            writer.write_line(r'\usepackage{times}')  # Use Times font
+            writer.write_line(r'\usepackage{hyperref}')
+            writer.write_line(r'\hypersetup{')
+            writer.write_line(r'  colorlinks=true')
+            writer.write_line(r'}')
+            writer.write_line(r'\author{' + f"{author}" + '}')
+            writer.write_line(r'\date{\today}')
+            writer.write_line(r'\title{' + f"{title}" + '}')
+            writer.write_line(r'\setcounter{secnumdepth}{6}')
+            writer.write_line(r'\setlength{\parindent}{0pt}')
+            writer.write_line(r'\setcounter{tocdepth}{6}')
+            writer.write_line(r'\begin{document}')
+            writer.write_line(r'\maketitle')
+            writer.write_line(r'\tableofcontents')
+            writer.write_line(r'\clearpage')
+        self.trunk.write_latex(writer)
         if do_index:
-            lines.append(r"\printindex")
+            writer.write_line(r"\printindex")
         if self.grokify:
-            lines.extend(self.generate_cross_reference())
+            writer.write_lines(self.generate_cross_reference())
         if wrap:
-            lines.append(r"\end{document}")
-        return "\n".join(lines)
+            writer.write_line(r"\end{document}")
 
     def to_html(self, wrap=True, include_json=False):
-        self.css_classes = {}
-        indent_level = 0
-        lines = []
-        lines.extend(self.trunk.to_html(indent_level))
-        lines.append("</body>")
+        out = io.StringIO()
+        self.write_html(out, wrap=wrap, include_json=include_json)
+        return out.getvalue()
+
+    def write_html(self, out, wrap=True, include_json=False):
+        """ Writes the html to the file like object out as it is produced, rather than
+        building it in memory. The css classes are collected before the body is
+        written so that the head can go out first."""
+        writer = LineWriter(out)
+        self.prepare_html()
         if wrap:
-            out_lines = []
-            out_lines.append("<!DOCTYPE html>")
-            out_lines.append("<html>")
-            out_lines.append(" <head>")
-            out_lines.append(f'<title>Roam2Doc Output from {str(self.source)}</title>')
-            out_lines.append('  <link rel="stylesheet" type="text/css" href="https://gongzhitaao.org/orgcss/org.css"/>')
-            out_lines.append("  <style>")
+            writer.write_line("<!DOCTYPE html>")
+            writer.write_line("<html>")
+            writer.write_line(" <head>")
+            writer.write_line(f'<title>Roam2Doc Output from {str(self.source)}</title>')
+            writer.write_line('  <link rel="stylesheet" type="text/css" href="https://gongzhitaao.org/orgcss/org.css"/>')
+            writer.write_line("  <style>")
             for class_spec in self.css_classes.values():
                 styles = class_spec['styles']
-                out_lines.append(f".{class_spec['name']}" + " {")
+                writer.write_line(f".{class_spec['name']}" + " {")
                 for style in styles:
-                    out_lines.append(f"   {style['name']}: {style['value']} !important;")
-                out_lines.append("}")
-            out_lines.append("  </style>")
+                    writer.write_line(f"   {style['name']}: {style['value']} !important;")
+                writer.write_line("}")
+            writer.write_line("  </style>")
             if include_json:
-                out_lines.append("  <script>")
-                obj_tree = json.dumps(self, default=lambda o:o.to_json_dict(), indent=4)
-                out_lines.append(f"      var obj_tree = {obj_tree};")
-                out_lines.append("  </script>")
-            out_lines.append(" </head>")
-            out_lines.append("<body>")
-            out_lines.extend(lines)
-            lines = out_lines
-        return "\n".join(lines)
+                writer.write_line("  <script>")
+                writer.write_line("      var obj_tree = ")
+                json.dump(self, out, default=lambda o:o.to_json_dict(), indent=4)
+                writer.write(";")
+                writer.write_line("  </script>")
+            writer.write_line(" </head>")
+            writer.write_line("<body>")
+        indent_level = 0
+        self.trunk.write_html(writer, indent_level)
+        writer.write_line("</body>")
+
+    def prepare_html(self):
+        """ Does the things that rendering the body used to do before the head could be
+        written: collects the css classes and makes sure the links are resolved, since
+        resolving a link by heading text adds a link target that shows up in the json."""
+        self.get_link_graph()
+        self.css_classes = {}
+        # same order as the nodes get rendered, so the style block comes out in first use order
+        for node in walk_nodes(self.trunk):
+            styles = node.get_css_styles()
+            if len(styles) > 0:
+                self.add_css_class(dict(name=css_class_name(node), styles=styles))
 
     def generate_cross_reference(self):
         lines = []
@@ -160,13 +374,8 @@ class Root:
         lines.append(r"\hline")
         lines.append(r"\textbf{Referenced Object} & \textbf{Referenced by} \\")
         lines.append(r"\hline")
-        records = []
-        for obj_id, target in self.link_targets.items():
-            refs = list(target.references)
-            if refs != []:
-                record = dict(target=target.target_node, references=refs)
-                records.append(record)
-        for record in records:
+        self.get_grok_target_ids()
+        for record in self.xref_records:
             tnode = record['target']
             refs = [str(ref.node_id) for ref in record['references']]
             refs =  ",".join(refs)
@@ -196,8 +405,11 @@ class Branch:
             parent = root
         self.parent = parent # could be attatched to a trunk branch, not just the root
         self.node_id = root.new_node_id()
-        self.children = [] # all the children will be sections, so in effect this is self.sections
+        root.add_to_index(self)
+        self.children = ChildList() # all the children will be sections, so in effect this is self.sections
         self.last_node_id = None
+        # made by make_outline, section node id to outline record
+        self.outline = None
         self.logger = logging.getLogger('roam2doc.tree')
 
     def find_root(self):
@@ -208,19 +420,78 @@ class Branch:
             self.children.append(node)
         
     def note_parse_done(self):
-        max_id = self.node_id
-        if self.children:
-            max_id = self.level_max_node_id(self, max_id)
+        max_id = max(node.node_id for node in walk_nodes(self))
         self.last_node_id = max_id
         self.logger.info("%s node id range is %d to %d",  str(self), self.node_id, max_id)
-
-    def level_max_node_id(self, node, max_id):
-        max_id = max(node.node_id, max_id)
-        if hasattr(node, "children"):
-            for child in node.children:
-                max_id = self.level_max_node_id(child, max_id)
-        return max_id
+        self.make_outline()
+
+    def make_outline(self):
+        """ Works out the nesting of the sections from their heading levels, see
+        get_parent_section. Each Section in children gets a record in outline, by
+        node id, with its logical parent section, its depth, which is 0 for a
+        section without a parent, its ordinal, counting from 1, among the sections
+        with the same parent, the sections that it is the parent of, and the
+        numbers of the lists directly in it as used in latex labels. A section
+        without a heading is not the parent of any other."""
+        self.outline = {}
+        counts = {}
+        # the sections that could be the parent of the next one, levels increasing
+        stack = []
+        for section in self.children:
+            if not isinstance(section, Section):
+                continue
+            level = None
+            if section.heading is not None:
+                level = section.heading.level
+                while stack and stack[-1].heading.level >= level:
+                    stack.pop()
+            parent = None
+            depth = 0
+            if level is not None and stack:
+                parent = stack[-1]
+                depth = self.outline[parent.node_id]['depth'] + 1
+            counts[id(parent)] = counts.get(id(parent), 0) + 1
+            list_numbers = {}
+            for child in section.children:
+                if isinstance(child, List):
+                    list_numbers[child.node_id] = len(list_numbers) + 1
+            self.outline[section.node_id] = dict(section=section, parent=parent, depth=depth,
+                                                 ordinal=counts[id(parent)], children=[],
+                                                 list_numbers=list_numbers)
+            if parent is not None:
+                self.outline[parent.node_id]['children'].append(section)
+            if level is not None:
+                stack.append(section)
+
+    def get_outline(self, section):
+        """ Returns the outline record of section, see make_outline."""
+        record = None
+        if self.outline is not None:
+            record = self.outline.get(section.node_id)
+        if record is None or record['section'] is not section:
+            self.make_outline()
+            record = self.outline.get(section.node_id)
+        return record
     
+    def splice_sections(self, index, count, new_sections):
+        """ Replaces count sections starting at index with new_sections, which have been
+        parsed into this branch and so are at the end of children. Link targets that
+        pointed into the removed sections are dropped and all the links are set to
+        resolve again."""
+        for section in new_sections:
+            self.children.remove(section)
+        removed = self.children[index:index + count]
+        self.children[index:index + count] = new_sections
+        removed_ids = set()
+        for section in removed:
+            for node in subtree_nodes(section):
+                removed_ids.add(id(node))
+                self.root.remove_from_index(node)
+                if isinstance(node, Heading):
+                    self.root.remove_heading(node)
+        self.root.drop_link_targets(removed_ids)
+        return removed
+
     def get_css_styles(self): 
         return []
     
@@ -242,86 +513,93 @@ class Branch:
             # previous heading. This can create strange effects
             # in the latex output and there is no practical
             # solution for that.
-            caller_index = self.children.index(node)
-            search = caller_index - 1
-            while search > -1:
-                maybe = self.children[search]
-                if maybe.heading.level < node.heading.level:
-                    return maybe
-                search -= 1
-            return None
-        if isinstance(node.parent, Section):
-            return node.parent
-        return self.get_parent_section(node.parent)
+            return self.get_outline(node)['parent']
+        parent = node.parent
+        while not isinstance(parent, Section):
+            if not isinstance(parent, Node):
+                return None
+            parent = parent.parent
+        return parent
 
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         for node in self.children:
-            lines.extend(node.to_latex())
-        return lines
+            node.write_latex(writer)
 
     def to_html(self, indent_level):
-        lines = []
+        writer = LineWriter()
+        self.write_html(writer, indent_level)
+        return writer.lines
+
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("div", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</div>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</div>')
     
     def __str__(self):
         return f"(self.node_id) branch from source {self.source}"
     
 class Node:
+    __slots__ = ('parent', 'root', 'branch', 'node_id', 'start_line', 'end_line', '_link_targets')
     
     def __init__(self, parent, start_line, end_line):
         self.parent = parent
-        self.root = self.find_root()
+        # kept up to date by move_to_parent so that nothing has to walk
+        # up the tree to find them
+        self.root, self.branch = tree_position(parent)
         self.node_id = self.root.new_node_id()
+        self.root.add_to_index(self)
         assert isinstance(start_line, int)
         self.start_line = start_line
         self.end_line = end_line
-        self.link_targets = []
         if self.parent != self.root:
             self.parent.add_node(self)
 
     def find_root(self):
-        parent = self.parent
-        while parent is not None and not isinstance(parent, Root):
-            parent = parent.parent
-        if isinstance(parent, Root):
-            return parent
-        raise Exception("cannot find root!")
+        return self.root
 
     def get_grok_tag(self):
         do = False
-        root = self.find_root()
+        root = self.root
         if root.grokify:
             if isinstance(self, Heading):
                 do = True
             else:
-                for lt in root.link_targets.values():
-                    if lt.target_node == self:
-                        do = True
+                do = self.node_id in root.get_grok_target_ids()
         if do:
             return f"(xref-id:{self.node_id})"
         return None
     
     def find_branch(self):
-        parent = self.parent
-        while parent is not None and not isinstance(parent, Branch):
-            parent = parent.parent
-        if isinstance(parent, Branch):
-            return parent
-        raise Exception("cannot find branch!")
+        if self.branch is None:
+            raise Exception("cannot find branch!")
+        return self.branch
 
     def get_latex_label_text(self):
         return self.parent.get_latex_label_text()
             
+    @property
+    def link_targets(self):
+        # most nodes are never link targets, so the list is only
+        # made for the ones that are
+        try:
+            return self._link_targets
+        except AttributeError:
+            return ()
+
     def add_link_target(self, target):
-        self.link_targets.append(target)
+        try:
+            self._link_targets.append(target)
+        except AttributeError:
+            self._link_targets = [target,]
 
     def move_to_parent(self, parent):
         if self.parent == parent:
@@ -332,6 +610,14 @@ class Node:
             except ValueError:
                 pass
         self.parent = parent
+        root, branch = tree_position(parent)
+        if root is not self.root or branch is not self.branch:
+            for node in subtree_nodes(self):
+                if root is not node.root:
+                    node.root.remove_from_index(node)
+                    root.add_to_index(node)
+                node.root = root
+                node.branch = branch
         self.parent.add_node(self)
         
     def to_json_dict(self):
@@ -346,12 +632,21 @@ class Node:
         return res
 
     def get_source_data(self):
-        data = dict(doc_source=self.find_root().source,
+        branch = self.find_branch()
+        lines = branch.parser.lines
+        # start_line and end_line are lines of the include expanded document,
+        # source_file and source_line say where the start line really came from
+        source_file = branch.source
+        source_line = self.start_line
+        if hasattr(lines, 'origin'):
+            path, source_line = lines.origin(self.start_line)
+            source_file = str(path)
+        data = dict(doc_source=self.root.source,
+                     source_file=source_file, source_line=source_line,
                      start_line=self.start_line, end_line=self.end_line,
                      start_pos=getattr(self, 'start_pos', None),
                      end_pos=getattr(self, 'end_pos', None))
 
-        lines = self.find_branch().parser.lines
         if self.start_line == self.end_line:
             source = lines[self.start_line]
             start_pos = getattr(self, 'start_pos', None)
@@ -367,6 +662,15 @@ class Node:
 
     def to_latex(self):
         return [f"class {self.__class__.__name__} has no to_latex method",]
+
+    def write_latex(self, writer):
+        # block level classes override this, inline ones just produce lines
+        writer.write_lines(self.to_latex())
+
+    def to_html(self, indent_level, **kwargs):
+        writer = LineWriter()
+        self.write_html(writer, indent_level, **kwargs)
+        return writer.lines
     
     def __str__(self):
         msg = f"({self.node_id}) {self.__class__.__name__} "
@@ -383,27 +687,34 @@ class BlankLine(Node):
     so desired. They often also mark the end of other elements, such as tables, lists,
     etc.
     """
+    __slots__ = ()
     def __init__(self, parent, start_line, end_line):
         super().__init__(parent, start_line, end_line)
+
+    @property
+    def count(self):
+        # more than one after coalesce_nodes merges a run of them
+        return self.end_line - self.start_line + 1
     
     def to_latex(self):
         # we don't record location, because we cannot be part of cross reference
-        return [r"\vspace{\baselineskip}"]  # Adds a blank line's worth of space
+        return [r"\vspace{\baselineskip}"] * self.count  # Adds a blank line's worth of space
         
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         line1 = " " * indent_level  * 4
         #line1 += '<span style="margin-bottom: 1em;"> </span>'
         line1 += '<br>'
-        return [line1,]
+        for i in range(self.count):
+            writer.write_line(line1)
     
 class Container(Node):
     """ This node contains one or more other nodes but does not directly contain text."""
+    __slots__ = ('children',)
 
     def __init__(self, parent, start_line, end_line):
         super().__init__(parent, start_line, end_line)
-        self.children = []
+        self.children = ChildList()
         
     def add_node(self, node):
         if node not in self.children:
@@ -412,24 +723,21 @@ class Container(Node):
         
     def remove_node(self, node):
         try:
-            index = self.children.index(node)
-            self.children.pop(index)
+            self.children.remove(node)
         except ValueError:
             pass
         
     def to_latex(self):
         return [f"class {self.__class__.__name__} has no to_latex method",]
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("div", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for child in self.children:
-            lines.extend(child.to_html(indent_level))
-        lines.append(padding + '</div>')
-        return lines
+            child.write_html(writer, indent_level)
+        writer.write_line(padding + '</div>')
     
     def to_json_dict(self):
         # don't include back links, up the tree
@@ -441,6 +749,7 @@ class Section(Container):
     """ This type of Container starts with a heading, or at the beginning of the file.
     It may have a set of properties from a "drawer". 
     """
+    __slots__ = ('heading',)
     def __init__(self, parent, start, end):
         super().__init__(parent, start, end)
         self.heading = None
@@ -462,29 +771,30 @@ class Section(Container):
         return tex_escape(self.heading.get_plain_text())
     
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         # if there is no heading, parse is broken, it is supposed to generate one
         # if the zeroth section has no heading, all other sections begin with
         # a heading by definition
-        lines.extend(self.heading.to_latex("start"))
+        writer.write_lines(self.heading.to_latex("start"))
         for node in self.children:
             if node != self.heading:
-                lines.extend(node.to_latex())
-        lines.extend(self.heading.to_latex("end"))
-        return lines
+                node.write_latex(writer)
+        writer.write_lines(self.heading.to_latex("end"))
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("div", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         if self.heading:
-            lines.extend(self.heading.to_html(indent_level))
+            self.heading.write_html(writer, indent_level)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</div>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</div>')
     
     def to_json_dict(self):
         if self.heading:
@@ -501,35 +811,39 @@ class Paragraph(Container):
     but does not start with a header. Cannot be the top level container, so it
     must have a parent.
     """
+    __slots__ = ()
     def __init__(self, parent, start, end):
         super().__init__(parent, start, end)
 
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         for node in self.children:
-            lines.extend(node.to_latex())
-        lines.append("")  # Blank line for paragraph break
-        return lines
+            node.write_latex(writer)
+        writer.write_line("")  # Blank line for paragraph break
 
-    def to_html(self, indent_level, zero_top_margin=False):
-        lines = []
+    def write_html(self, writer, indent_level, zero_top_margin=False):
         indent_level += 1
         padding, line1 = setup_tag_open("p", indent_level, self)
         if zero_top_margin:
             line1 += ' style="margin-top: 0 !important" '
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</p>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</p>')
         
 class Text(Node):
-    """ A node that has actual content, meaning text."""
+    """ A node that has actual content, meaning text. When the text is just what the
+    node's span covers in the parser's lines, the span is all that is kept and the
+    text is read back from the lines when asked for."""
+    __slots__ = ('_text', 'start_pos', 'end_pos')
 
     def __init__(self, parent, start_line, end_line, text, start_pos=None, end_pos=None):
         super().__init__(parent, start_line, end_line)
-        self.text = text
         self.start_pos = start_pos
         self.end_pos = end_pos
         if self.start_line == self.end_line:
@@ -538,11 +852,42 @@ class Text(Node):
             # handing nested objects like <<*/foo/*>>
             # but we can work it out
             if self.start_pos is None or self.end_pos is None:
-                parser = self.find_branch().parser
+                parser = self.branch.parser
                 line = parser.lines[self.start_line]
                 if text in line: # sanity check
                     self.start_pos = line.index(text)
                     self.end_pos = self.start_pos + len(text)
+        self.text = text
+
+    @property
+    def text(self):
+        if self._text is None:
+            return self.get_source_text()
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        # None means read it from the lines
+        if value == self.get_source_text():
+            self._text = None
+        else:
+            self._text = value
+
+    def get_source_lines(self):
+        branch = self.branch
+        if branch is None or getattr(branch, 'parser', None) is None:
+            return None
+        return branch.parser.lines
+
+    def get_source_text(self):
+        """ The part of the source line that start_pos and end_pos cover, or None
+        if there isn't one."""
+        if self.start_line != self.end_line or self.start_pos is None or self.end_pos is None:
+            return None
+        lines = self.get_source_lines()
+        if lines is None:
+            return None
+        return lines[self.start_line][self.start_pos:self.end_pos + 1]
 
     def get_plain_text(self):
         return self.text
@@ -552,29 +897,67 @@ class Text(Node):
         text = tex_escape(self.text)
         return [text]
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("span", indent_level, self)
         line1 += f">{self.text}</span>"
-        return [line1,]
+        writer.write_line(line1)
     
     def to_json_dict(self):
         res = super().to_json_dict()
         res['props']['text'] = self.text
         return res
         
+class TextRun(Text):
+    """ The plain Text nodes of consecutive lines of a paragraph merged into one by
+    coalesce_nodes, the text being their texts joined with newlines. line_spans holds
+    the start and end position of the text on each line, from start_line on.
+    """
+    __slots__ = ('line_spans',)
+
+    def __init__(self, parent, texts):
+        self.line_spans = [(text.start_pos, text.end_pos) for text in texts]
+        super().__init__(parent, texts[0].start_line, texts[-1].end_line,
+                         '\n'.join(text.text for text in texts),
+                         texts[0].start_pos, texts[-1].end_pos)
+
+    def get_source_text(self):
+        lines = self.get_source_lines()
+        if lines is None:
+            return None
+        parts = []
+        for offset, (start_pos, end_pos) in enumerate(self.line_spans):
+            parts.append(lines[self.start_line + offset][start_pos:end_pos + 1])
+        return '\n'.join(parts)
+
+    def to_json_dict(self):
+        res = super().to_json_dict()
+        res['props']['line_spans'] = [list(span) for span in self.line_spans]
+        return res
+
 class Heading(Container):
     """ An org heading, meaning it starts with one or more asterisks. Always starts a new
     Section, but not all Sections start with a heading. May have a parent, may not.
     """
+    __slots__ = ('level', 'original_text', 'text', '_properties')
     def __init__(self, parent, start_line, end_line, level, original_text):
         super().__init__(parent, start_line, end_line)
         self.level = level
         # this allows heading to be a link target by text match
         self.original_text = original_text
         self.text = None
-        self.properties = {}
+        self.root.add_heading(self)
+
+    @property
+    def properties(self):
+        try:
+            return self._properties
+        except AttributeError:
+            return {}
+
+    @properties.setter
+    def properties(self, value):
+        self._properties = value
 
     def get_plain_text(self):
         if self.text:
@@ -648,8 +1031,7 @@ class Heading(Container):
         return lines
 
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         level = self.level
         if self.level > 6:
@@ -658,14 +1040,13 @@ class Heading(Container):
         padding, line1 = setup_tag_open(f"h{level}", indent_level, self)
         if self.text:
             line1 += f">{self.text}</h{level}>"
-            lines.append(line1)
-            return lines
+            writer.write_line(line1)
+            return
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for child in self.children:
-            lines.extend(child.to_html(indent_level))
-        lines.append(padding + f"</h{level}>")
-        return lines
+            child.write_html(writer, indent_level)
+        writer.write_line(padding + f"</h{level}>")
         
     def to_json_dict(self):
         res = super().to_json_dict()
@@ -685,12 +1066,11 @@ class TargetText(Text):
     it can be the target of a link. This is for the <<link-to-text>> form which
     needs special processing on conversion to other formats. 
     """
+    __slots__ = ()
     def __init__(self, parent, start_line, start_pos, end_pos, text):
-        super().__init__(parent, start_line, start_line, text)
-        root = self.find_root()
-        root.add_link_target(self, text)
-        self.start_pos = start_pos
-        self.end_pos = end_pos
+        # the span includes the angle brackets, so the text is kept
+        super().__init__(parent, start_line, start_line, text, start_pos, end_pos)
+        self.root.add_link_target(self, text)
 
     def to_latex(self):
         # Escape special LaTeX characters
@@ -701,12 +1081,11 @@ class TargetText(Text):
             line += f"{tex_escape(gt)}"
         return [line,]
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("span", indent_level, self)
         line1 += "</span>"
-        return [line1,]
+        writer.write_line(line1)
     
 class LinkTarget():
     """
@@ -733,15 +1112,22 @@ class LinkTarget():
     :CUSTOM_ID: link-to-text
     :END:
     """
+    __slots__ = ('target_node', 'target_text', 'references', 'referenced')
     def __init__(self, target_node, target_text):
         self.target_node = target_node
         self.target_text = target_text
         self.target_node.add_link_target(self)
         self.references = []
+        self.referenced = set()
 
     def note_reference(self, node):
-        if node not in self.references:
+        if node not in self.referenced:
+            self.referenced.add(node)
             self.references.append(node)
+
+    def clear_references(self):
+        self.references = []
+        self.referenced = set()
         
     def to_json_dict(self):
         res = dict(target_node=str(self.target_node), target_text=self.target_text)
@@ -749,12 +1135,34 @@ class LinkTarget():
 
 
 class TextTag(Container):
+    __slots__ = ('_simple_text', 'start_pos', 'end_pos')
 
     def __init__(self, parent, start_line, start_pos, end_pos, simple_text):
         super().__init__(parent, start_line, start_line)
-        self.simple_text = simple_text
         self.start_pos = start_pos
         self.end_pos = end_pos
+        self.simple_text = simple_text
+
+    @property
+    def simple_text(self):
+        if self._simple_text is True:
+            return self.get_source_text()
+        return self._simple_text
+
+    @simple_text.setter
+    def simple_text(self, value):
+        # True means it is the source text between the markers
+        if value and value == self.get_source_text():
+            self._simple_text = True
+        else:
+            self._simple_text = value
+
+    def get_source_text(self):
+        """ The text between the one character markers at start_pos and end_pos."""
+        branch = self.branch
+        if branch is None or getattr(branch, 'parser', None) is None:
+            return None
+        return branch.parser.lines[self.start_line][self.start_pos + 1:self.end_pos]
 
     def to_latex(self):
         latex_tag = {
@@ -790,41 +1198,45 @@ class TextTag(Container):
     def get_css_styles(self):
         return [dict(name="font-weight", value="bold"),]
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open(f"{self.tag}", indent_level, self)
         if self.simple_text:
             line1 += f">{self.simple_text}</{self.tag}>"
-            lines.append(line1)
+            writer.write_line(line1)
         else:
             line1 += ">"
-            lines.append(line1)
+            writer.write_line(line1)
             for node in self.children:
-                lines.extend(node.to_html(indent_level))
-            lines.append(padding + f'</{self.tag}>')
+                node.write_html(writer, indent_level)
+            writer.write_line(padding + f'</{self.tag}>')
             
-        return lines
     
 class BoldText(TextTag):
+    __slots__ = ()
     tag = 'b'
     
 class ItalicText(TextTag):
+    __slots__ = ()
     tag = 'i'
 
 class UnderlinedText(TextTag):
+    __slots__ = ()
     tag = 'u'
 
 class LinethroughText(TextTag):
+    __slots__ = ()
     tag = 's'
 
 class InlineCodeText(TextTag):
+    __slots__ = ()
     tag = 'code'
 
     def get_css_styles(self):
         return [dict(name="font-family", value="monospace"),]
     
 class VerbatimText(TextTag):
+    __slots__ = ()
     tag = 'code'
 
     def get_css_styles(self):
@@ -839,46 +1251,53 @@ class VerbatimText(TextTag):
         return lines
 
 class CenterBlock(Container):
+    __slots__ = ()
     
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
-        lines.append(r"\begin{center}")
+            writer.write_line(f" {tex_escape(gt)}")
+        writer.write_line(r"\begin{center}")
         for node in self.children:
-            lines.extend(node.to_latex())
-        lines.append(r"\end{center}")
-        return lines
+            node.write_latex(writer)
+        writer.write_line(r"\end{center}")
     
     def get_css_styles(self):
         return [dict(name="text-align", value="center"),]
     
 class QuoteBlock(Container):
+    __slots__ = ('cite',)
 
     def __init__(self, parent, start_line, end_line, cite=None, content=None):
         super().__init__(parent, start_line, end_line)
         self.cite = cite
-        self.children = []
+        self.children = ChildList()
         if content:
             for item in content:
                 item.move_to_parent(self)
         
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
-        lines.append(r"\begin{quote}")
+            writer.write_line(f" {tex_escape(gt)}")
+        writer.write_line(r"\begin{quote}")
         for node in self.children:
-            lines.extend(node.to_latex())
-        lines.append(r"\end{quote}")
+            node.write_latex(writer)
+        writer.write_line(r"\end{quote}")
         if self.cite:
-            lines.append(f"--- {self.cite}")
-        return lines
+            writer.write_line(f"--- {self.cite}")
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("blockquote", indent_level, self)
         if self.cite:
@@ -886,13 +1305,22 @@ class QuoteBlock(Container):
         else:
             line1 += '>'
             
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</blockquote>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</blockquote>')
 
 class CodeBlock(Text):
+    __slots__ = ()
+
+    def get_source_text(self):
+        """ The lines from start_line to end_line, without their indent or the comma
+        that escapes a leading star or #+."""
+        lines = self.get_source_lines()
+        if lines is None:
+            return None
+        block = lines[self.start_line:self.end_line + 1]
+        return '\n'.join(line.lstrip().lstrip(',') for line in block)
 
     def get_css_styles(self):
         return [dict(name="white-space", value="pre-wrap"),
@@ -908,47 +1336,54 @@ class CodeBlock(Text):
         lines.append(r"\end{verbatim}")
         return lines
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("code", indent_level, self)
         line1 += ">"
-        lines.append(line1)
-        lines.append(self.text)
-        lines.append(padding + '</code>')
-        return lines
+        writer.write_line(line1)
+        writer.write_line(self.text)
+        writer.write_line(padding + '</code>')
 
 
 class ExampleBlock(CodeBlock):
+    __slots__ = ()
     pass
 
 
 class CommentBlock(CodeBlock):
+    __slots__ = ()
     pass
 
 class ExportBlock(CodeBlock):
+    __slots__ = ()
     pass
 
 
 class List(Container):
+    __slots__ = ('margin',)
 
     def __init__(self, parent, start_line, end_line,  margin=None):
         super().__init__(parent, start_line, end_line)
         self.margin = margin
 
     def get_latex_label_text(self):
-        section = self.find_branch().get_parent_section(self)
+        section = self.branch.get_parent_section(self)
         stack = self.get_list_stack()
         top_list = stack[0]
         lines = []
         list_index = 0
         if top_list == self:
-            for index, child in enumerate(section.children):
-                if child == self:
-                    break
-                if isinstance(child, List):
-                    list_index += 1
-            list_number = list_index + 1
+            list_number = None
+            record = self.branch.get_outline(section)
+            if record is not None:
+                list_number = record['list_numbers'].get(self.node_id)
+            if list_number is None:
+                for index, child in enumerate(section.children):
+                    if child == self:
+                        break
+                    if isinstance(child, List):
+                        list_index += 1
+                list_number = list_index + 1
             last_part = f"list number {list_number}"
         else:
             last_part = f"sublist"
@@ -974,6 +1409,7 @@ class List(Container):
         return stack
         
 class ListItem(Container):
+    __slots__ = ('line_contents',)
 
     def __init__(self, parent, start_line, end_line, line_contents=None):
         super().__init__(parent, start_line, end_line)
@@ -982,9 +1418,6 @@ class ListItem(Container):
             for item in line_contents:
                 self.line_contents.append(len(self.line_contents))
                 item.move_to_parent(self)
-        # while parsing it is helpful to be able to collect lines that will
-        # be processed as paragraph data until the moment for parsing arrives
-        self.para_lines = []
 
     def get_latex_label_text(self):
         parts = []
@@ -1001,7 +1434,7 @@ class ListItem(Container):
         res.strip(" > ")
         return res
     
-    def to_html(self, indent_level):
+    def write_html(self, writer, indent_level):
 
         add_this = """<ol>
         <li seq="1">Item one</li>
@@ -1009,18 +1442,16 @@ class ListItem(Container):
         <li seq="300">Item three hundred</li>
         </ol>
         """
-        lines = []
         indent_level += 1
         padding, line1 = setup_tag_open("li", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
             if isinstance(node, Paragraph):
-                lines.extend(node.to_html(indent_level, zero_top_margin=True))
+                node.write_html(writer, indent_level, zero_top_margin=True)
             else:
-                lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</li>')
-        return lines
+                node.write_html(writer, indent_level)
+        writer.write_line(padding + '</li>')
 
     def to_json_dict(self):
         ## fiddle the resluts around to make it easier to understand
@@ -1032,45 +1463,51 @@ class ListItem(Container):
         return res
     
 class OrderedList(List):
+    __slots__ = ()
 
-    def to_latex(self):  # For OrderedList
-        lines = []
+    def to_latex(self):
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):  # For OrderedList
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
+            writer.write_line(f" {tex_escape(gt)}")
         line = r"\begin{enumerate}"
         if len(self.link_targets) > 0:
             my_label = f" \\label{{obj-{self.node_id}}}"
             line += my_label
-        lines.append(line)
+        writer.write_line(line)
         for node in self.children:
-            lines.extend(node.to_latex())
-        lines.append(r"\end{enumerate}")
-        return lines
+            node.write_latex(writer)
+        writer.write_line(r"\end{enumerate}")
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("ol", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</ol>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</ol>')
 
 
 class OrderedListItem(ListItem):
+    __slots__ = ('ordinal',)
 
-    def to_latex(self):  # For ListItem
-        lines = []
+    def to_latex(self):
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):  # For ListItem
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
-        lines.append(r"\item")
+            writer.write_line(f" {tex_escape(gt)}")
+        writer.write_line(r"\item")
         for node in self.children:
-            lines.extend(node.to_latex())
-        return lines
+            node.write_latex(writer)
 
     def __init__(self, parent, start_line, end_line, ordinal=None, line_contents=None):
         super().__init__(parent, start_line, end_line, line_contents)
@@ -1078,75 +1515,84 @@ class OrderedListItem(ListItem):
 
 
 class UnorderedList(List):
+    __slots__ = ()
 
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
+            writer.write_line(f" {tex_escape(gt)}")
         line = r"\begin{itemize}"
         if len(self.link_targets) > 0:
             my_label = f" \\label{{obj-{self.node_id}}}"
             line += my_label
-        lines.append(line)
+        writer.write_line(line)
         for node in self.children:
-            lines.extend(node.to_latex())
-        lines.append(r"\end{itemize}")
-        return lines
+            node.write_latex(writer)
+        writer.write_line(r"\end{itemize}")
     
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("ul", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</ul>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</ul>')
 
 
 class UnorderedListItem(ListItem):
+    __slots__ = ()
 
-    def to_latex(self):  # For ListItem
-        lines = []
-        lines.append(r"\item")
+    def to_latex(self):
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):  # For ListItem
+        writer.write_line(r"\item")
         for node in self.children:
-            lines.extend(node.to_latex())
-        return lines
+            node.write_latex(writer)
 
 
 class DefinitionList(List):
+    __slots__ = ()
 
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
+            writer.write_line(f" {tex_escape(gt)}")
         line = r"\begin{description}"
         if len(self.link_targets) > 0:
             my_label = f" \\label{{obj-{self.node_id}}}"
             line += my_label
-        lines.append(line)
+        writer.write_line(line)
         for node in self.children:
-            lines.extend(node.to_latex())
-        lines.append(r"\end{description}")
-        return lines
+            node.write_latex(writer)
+        writer.write_line(r"\end{description}")
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("dl", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        lines.append(padding + '</dl>')
-        return lines
+            node.write_html(writer, indent_level)
+        writer.write_line(padding + '</dl>')
 
 
 class DefinitionListItem(ListItem):
+    __slots__ = ('title', 'description')
 
     def __init__(self, parent, start_line, end_line, title, description):
         super().__init__(parent, start_line, end_line)
@@ -1156,30 +1602,31 @@ class DefinitionListItem(ListItem):
         # Let this be ugly instead of spreading it far and wide
         title.move_to_parent(self)
         description.move_to_parent(self)
-        self.children = []
+        self.children = ChildList()
         self.title = title
         self.description = description
 
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
+            writer.write_line(f" {tex_escape(gt)}")
         title = self.title.to_latex()[0]  # Assuming single line
-        lines.append(f"\\item[{title}]")
-        lines.extend(self.description.to_latex())
+        writer.write_line(f"\\item[{title}]")
+        self.description.write_latex(writer)
         for node in self.children:
-            lines.extend(node.to_latex())
-        return lines
+            node.write_latex(writer)
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
-        lines.extend(self.title.to_html(indent_level))
-        lines.extend(self.description.to_html(indent_level))
+        self.title.write_html(writer, indent_level)
+        self.description.write_html(writer, indent_level)
         for node in self.children:
-            lines.extend(node.to_html(indent_level))
-        return lines
+            node.write_html(writer, indent_level)
 
     def to_json_dict(self):
         ## fiddle the resluts around to make it easier to understand
@@ -1192,6 +1639,7 @@ class DefinitionListItem(ListItem):
         return res
     
 class DefinitionListItemTitle(Text):
+    __slots__ = ()
 
     def to_latex(self):
         text = tex_escape(self.text)
@@ -1200,37 +1648,38 @@ class DefinitionListItemTitle(Text):
             text += f" {tex_escape(gt)}"
         return [text]
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("dt", indent_level, self)
         line1 += f">{self.text}</dt>"
-        lines.append(line1)
-        return lines
+        writer.write_line(line1)
 
 class DefinitionListItemDescription(ListItem): # use to get contents support
+    __slots__ = ()
 
     def to_latex(self):
-        lines = []
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
+            writer.write_line(f" {tex_escape(gt)}")
         for child in self.children:
-            lines.extend(child.to_latex())
-        return lines
+            child.write_latex(writer)
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("dd", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for child in self.children:
-            lines.extend(child.to_html(indent_level))
-        lines.append(padding + '</dd>')
-        return lines
+            child.write_html(writer, indent_level)
+        writer.write_line(padding + '</dd>')
 
 class Table(Container):
+    __slots__ = ()
 
     def get_css_styles(self):
         res = []
@@ -1239,36 +1688,38 @@ class Table(Container):
         res.append(dict(name="border", value="1px solid black"))
         return res
 
-    def to_latex(self):  # For Table
-        lines = []
+    def to_latex(self):
+        writer = LineWriter()
+        self.write_latex(writer)
+        return writer.lines
+
+    def write_latex(self, writer):  # For Table
         gt = self.get_grok_tag()
         if gt:
-            lines.append(f" {tex_escape(gt)}")
+            writer.write_line(f" {tex_escape(gt)}")
         num_cols = max(len(row.children) for row in self.children if isinstance(row, TableRow))
         if len(self.link_targets) > 0:
             my_label = f" \\label{{obj-{self.node_id}}}"
-            lines.append(my_label)
-        lines.append(r"\begin{tabular}{" + "|c" * num_cols + "|}")
-        lines.append(r"\hline")
+            writer.write_line(my_label)
+        writer.write_line(r"\begin{tabular}{" + "|c" * num_cols + "|}")
+        writer.write_line(r"\hline")
         for child in self.children:
-            lines.extend(child.to_latex())
-        lines.append(r"\hline")
-        lines.append(r"\end{tabular}")
-        return lines
+            child.write_latex(writer)
+        writer.write_line(r"\hline")
+        writer.write_line(r"\end{tabular}")
 
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("table", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for child in self.children:
-            lines.extend(child.to_html(indent_level))
-        lines.append(padding + '</table>')
-        return lines
+            child.write_html(writer, indent_level)
+        writer.write_line(padding + '</table>')
 
 class TableRow(Container):
+    __slots__ = ()
 
     def get_css_styles(self):
         res = []
@@ -1286,18 +1737,17 @@ class TableRow(Container):
         row += r' \\'
         return [row,]
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("tr", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for child in self.children:
-            lines.extend(child.to_html(indent_level))
-        lines.append(padding + '</tr>')
-        return lines
+            child.write_html(writer, indent_level)
+        writer.write_line(padding + '</tr>')
 
 class TableCell(Container):
+    __slots__ = ()
 
     def get_css_styles(self):
         res = []
@@ -1310,23 +1760,22 @@ class TableCell(Container):
             lines.extend(child.to_latex())
         return lines
         
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("td", indent_level, self)
         line1 += ">"
-        lines.append(line1)
+        writer.write_line(line1)
         for child in self.children:
-            lines.extend(child.to_html(indent_level))
-        lines.append(padding + '</td>')
-        return lines
+            child.write_html(writer, indent_level)
+        writer.write_line(padding + '</td>')
 
 
 class Link(Container):
+    __slots__ = ('target_text', 'display_text', 'start_pos', 'end_pos')
 
     def __init__(self, parent, start_line, start_pos, end_pos, target_text, display_text=None):
         super().__init__(parent, start_line, start_line)
-        self.children = []
+        self.children = ChildList()
         self.target_text = target_text
         self.display_text = display_text
         self.start_pos = start_pos
@@ -1343,8 +1792,7 @@ class Link(Container):
                     display_text += sub
         return [f"\\href{{{target_text}}}{{{display_text}}}"]
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("a", indent_level, self)
         line1 += f' href="{self.target_text}">'
@@ -1357,8 +1805,7 @@ class Link(Container):
         else:
             line1 += f'{self.target_text}'
         line1 += '</a>'
-        lines.append(line1)
-        return lines
+        writer.write_line(line1)
 
     def to_json_dict(self):
         ## fiddle the resluts around to make it easier to understand
@@ -1370,10 +1817,12 @@ class Link(Container):
         return res
 
 class InternalLink(Link):
+    __slots__ = ('target_node',)
 
     def __init__(self, *args, **argv):
         super().__init__(*args, **argv)
         self.target_node = None
+        self.root.link_graph = None
 
     def to_latex(self):
         lines = []
@@ -1393,8 +1842,7 @@ class InternalLink(Link):
         else:
             # Use display_text directly if no nested content
             display_text = (self.display_text or self.target_text).replace("#", r"\#").replace("&", r"\&").replace("_", r"\_")
-        root = self.find_root()
-        if root.grokify:
+        if self.root.grokify:
             id_string = tex_escape(f" (xref:{self.node_id})")
             display_text += id_string
         lines.append(f"\\hyperref[obj-{target.node_id}]{{{display_text}}}")
@@ -1402,16 +1850,11 @@ class InternalLink(Link):
         return lines
     
     def find_target(self):
-        if not self.target_node:
-            res = self.find_root().get_link_target(self.target_text)
-            self.target_node = res['node']
-            linker = res['link_target']
-            if linker:
-                linker.note_reference(self)
+        # the links are all resolved at once by the root
+        self.root.get_link_graph()
         return self.target_node
 
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         target = self.find_target()
         if not target:
@@ -1419,19 +1862,18 @@ class InternalLink(Link):
             line1 += 'style="color: red; font-style: italic; font-weight: bold;">'
             line1 += f' !!! link target "{self.target_text}" not found !!!'
             line1 += "</span>"
-            lines.append(line1)
-            return lines
+            writer.write_line(line1)
+            return
         padding, line1 = setup_tag_open("a", indent_level, self)
         line1 += f' href="#obj-{target.node_id}">'
         if self.display_text:
             display_text = self.display_text
             line1 += f'{display_text}</a>'
-        lines.append(line1)
+        writer.write_line(line1)
         if len(self.children) > 0:
             for child in self.children:
-                lines.extend(child.to_html(indent_level))
-            lines.append(padding + '</a>')
-        return lines
+                child.write_html(writer, indent_level)
+            writer.write_line(padding + '</a>')
 
     def to_json_dict(self):
         ## fiddle the resluts around to make it easier to understand
@@ -1442,6 +1884,7 @@ class InternalLink(Link):
         return res
         
 class Image(Node):
+    __slots__ = ('src_text', 'alt_text')
     
     def __init__(self, parent, start_line, end_line, src_text, alt_text=None):
         super().__init__(parent, start_line, end_line)
@@ -1464,15 +1907,14 @@ class Image(Node):
         lines.append(r'\end{figure}')
         return lines
     
-    def to_html(self, indent_level):
-        lines = []
+    def write_html(self, writer, indent_level):
         indent_level += 1
         padding, line1 = setup_tag_open("img", indent_level, self)
         line1 += f' src="{self.src_text}"'
         if self.alt_text:
             line1 += f' alt="{self.alt_text}>"'
         line1 += '</img>'
-        return [line1,]
+        writer.write_line(line1)
 
     def to_json_dict(self):
         ## fiddle the resluts around to make it easier to understand
@@ -1484,12 +1926,296 @@ class Image(Node):
         return res
 
 
+class ChildList:
+    """ The children of a Container or Branch. Iterates and indexes like the list it
+    replaces, but once there are more than a few children, membership, removal and
+    finding a child's index don't scan them. Past index_threshold children they are
+    also kept as the keys of an insertion ordered dict, the plain list and the index
+    of each child are made again from it when something other than an append has made
+    them out of date. Most containers only ever have a handful of children and get
+    by with the list alone.
+    """
+    __slots__ = ('node_list', 'nodes', 'positions')
+    index_threshold = 16
+
+    def __init__(self, nodes=()):
+        self.node_list = []
+        self.nodes = None
+        self.positions = None
+        for node in nodes:
+            self.append(node)
+
+    def append(self, node):
+        if node in self:
+            raise ValueError("node is already a child")
+        if self.nodes is not None:
+            self.nodes[node] = None
+        if self.node_list is not None:
+            if self.positions is not None:
+                self.positions[node] = len(self.node_list)
+            self.node_list.append(node)
+            if self.nodes is None and len(self.node_list) > self.index_threshold:
+                self.nodes = dict.fromkeys(self.node_list)
+
+    def remove(self, node):
+        if self.nodes is None:
+            self.node_list.remove(node)
+            self.positions = None
+            return
+        if node not in self.nodes:
+            raise ValueError("node is not a child")
+        del self.nodes[node]
+        if self.node_list and self.node_list[-1] is node:
+            self.node_list.pop()
+            if self.positions is not None:
+                del self.positions[node]
+        else:
+            self.node_list = None
+            self.positions = None
+
+    def pop(self, index=-1):
+        node = self.get_list()[index]
+        self.remove(node)
+        return node
+
+    def index(self, node):
+        if self.nodes is None:
+            return self.node_list.index(node)
+        if self.positions is None:
+            self.positions = {child: pos for pos, child in enumerate(self.get_list())}
+        if node not in self.positions:
+            raise ValueError("node is not a child")
+        return self.positions[node]
+
+    def get_list(self):
+        if self.node_list is None:
+            self.node_list = list(self.nodes)
+            self.positions = None
+        return self.node_list
+
+    def __contains__(self, node):
+        if self.nodes is not None:
+            return node in self.nodes
+        return node in self.node_list
+
+    def __len__(self):
+        if self.nodes is not None:
+            return len(self.nodes)
+        return len(self.node_list)
+
+    def __iter__(self):
+        return iter(self.get_list())
+
+    def __reversed__(self):
+        return reversed(self.get_list())
+
+    def __getitem__(self, index):
+        return self.get_list()[index]
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, slice):
+            raise TypeError("children can only be replaced by slice")
+        new_list = list(self.get_list())
+        new_list[index] = value
+        self.set_nodes(new_list)
+
+    def set_nodes(self, new_list):
+        nodes = dict.fromkeys(new_list)
+        if len(nodes) != len(new_list):
+            raise ValueError("a node can only be a child once")
+        self.node_list = new_list
+        self.nodes = nodes if len(new_list) > self.index_threshold else None
+        self.positions = None
+
+    def __eq__(self, other):
+        if isinstance(other, ChildList):
+            other = other.get_list()
+        return self.get_list() == other
+
+    def __getstate__(self):
+        return dict(nodes=self.get_list())
+
+    def __setstate__(self, state):
+        self.set_nodes(list(state['nodes']))
+
+    def __repr__(self):
+        return f"ChildList({self.get_list()!r})"
+
+
+class LinkGraph:
+    """ The internal links of a tree and the nodes they resolve to, made by
+    Root.resolve_links. Links without a target are in broken.
+    """
+
+    def __init__(self):
+        self.target_by_link = {}
+        self.links_by_target = defaultdict(list)
+        self.broken = []
+
+    def add_link(self, link, target):
+        self.target_by_link[link] = target
+        if target is None:
+            self.broken.append(link)
+        else:
+            self.links_by_target[target].append(link)
+
+    def get_target(self, link):
+        return self.target_by_link.get(link, None)
+
+    def get_links_to(self, node):
+        return self.links_by_target.get(node, [])
+
+
+def tree_position(parent):
+    """ Returns the root and the branch, which is None above the branches, that a node
+    with the given parent is in."""
+    if isinstance(parent, Root):
+        return parent, None
+    if isinstance(parent, Branch):
+        return parent.root, parent
+    return parent.root, parent.branch
+
+def walk_nodes(top, classes=None, prune=None):
+    """ Iterates over the nodes from top down in the order they are rendered, with a
+    node's heading, title and description ahead of its children, using a stack
+    rather than recursion so that deep nesting is no problem. Only the nodes that
+    are instances of classes are given if it is not None, a class or a tuple of
+    them as for isinstance. prune is a function that gets each node and returns
+    True if the nodes under it should be skipped."""
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        if classes is None or isinstance(node, classes):
+            yield node
+        if prune is not None and prune(node):
+            continue
+        kids = []
+        for name in ('heading', 'title', 'description'):
+            extra = getattr(node, name, None)
+            if isinstance(extra, Node):
+                kids.append(extra)
+        kids.extend(getattr(node, 'children', []))
+        kids.reverse()
+        stack.extend(kids)
+
+def normalize_heading_text(text):
+    return ' '.join(text.split()).casefold()
+
+def coalesce_nodes(top):
+    """ Merges each run of BlankLines on consecutive lines into the first of them, and
+    each run of plain Text nodes on consecutive lines of a paragraph into a TextRun,
+    everywhere below top. The rendered output stays the same apart from the html
+    having one span per run. Returns the number of nodes removed from the tree."""
+    removed = 0
+    for node in subtree_nodes(top):
+        children = getattr(node, 'children', None)
+        if children is None or len(children) < 2:
+            continue
+        # a new TextRun adds itself to the children, set_nodes drops that
+        old_children = list(children)
+        new_children = coalesce_children(node, old_children)
+        if len(new_children) < len(old_children):
+            removed += len(old_children) - len(new_children)
+            node.children.set_nodes(new_children)
+    return removed
+
+def coalesce_children(parent, children):
+    res = []
+    pos = 0
+    while pos < len(children):
+        node = children[pos]
+        end = pos + 1
+        if type(node) is BlankLine:
+            while (end < len(children) and type(children[end]) is BlankLine
+                   and children[end].start_line == children[end - 1].end_line + 1):
+                end += 1
+            if end - pos > 1:
+                node.end_line = children[end - 1].end_line
+                for merged in children[pos + 1:end]:
+                    parent.root.remove_from_index(merged)
+            res.append(node)
+        elif isinstance(parent, Paragraph) and can_merge_text(node):
+            while (end < len(children) and can_merge_text(children[end])
+                   and children[end].start_line == children[end - 1].end_line + 1):
+                end += 1
+            if end - pos > 1:
+                run = TextRun(parent, children[pos:end])
+                # keep the id of the first, the others go away
+                parent.root.remove_from_index(run)
+                for merged in children[pos:end]:
+                    parent.root.remove_from_index(merged)
+                run.node_id = node.node_id
+                parent.root.add_to_index(run)
+                res.append(run)
+            else:
+                res.append(node)
+        else:
+            res.append(node)
+        pos = end
+    return res
+
+def can_merge_text(node):
+    return (type(node) is Text and not node.link_targets and node.start_line == node.end_line
+            and node.start_pos is not None and node.end_pos is not None)
+
+def subtree_nodes(top):
+    """ All the nodes from top down, including the ones that are held as attributes
+    rather than as children, such as section headings."""
+    nodes = []
+    seen = set()
+    stack = [top]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes.append(node)
+        stack.extend(getattr(node, 'children', []))
+        for name in ('heading', 'title', 'description'):
+            extra = getattr(node, name, None)
+            if extra is not None and hasattr(extra, 'node_id'):
+                stack.append(extra)
+    return nodes
+
+class LineWriter:
+    """ Receives the output lines of the write_html and write_latex methods. With a file
+    like object the lines are written to it as they arrive, newline separated, otherwise
+    they are collected in the lines list.
+    """
+    def __init__(self, out=None):
+        self.out = out
+        self.lines = []
+        self.line_count = 0
+
+    def write_line(self, line):
+        if self.out is None:
+            self.lines.append(line)
+        else:
+            if self.line_count > 0:
+                self.out.write("\n")
+            self.out.write(line)
+        self.line_count += 1
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.write_line(line)
+
+    def write(self, text):
+        # adds to the end of the current line
+        if self.out is None:
+            self.lines[-1] += text
+        else:
+            self.out.write(text)
+
+def css_class_name(obj):
+    return f"org-auto-{obj.__class__.__name__}"
+
 def setup_tag_open(tag, indent_level, obj):
-    root = obj.find_root()
+    root = obj.root
     padding = " " * indent_level  * 4
     line1 = padding
     line1 += f'<{tag} id="obj-{obj.node_id}" '
-    classname = f"org-auto-{obj.__class__.__name__}"
+    classname = css_class_name(obj)
     styles = obj.get_css_styles()
     selector = classname
     if len(styles) > 0:
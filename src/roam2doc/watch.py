@@ -0,0 +1,255 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from pathlib import Path
+from roam2doc.io import FilesToParsers, list_directory, read_filelist
+from roam2doc.images import clear_prefetch
+logger = logging.getLogger('roam2doc.watch')
+
+
+class WatchedInput:
+    """ The input named on the command line, parsed and kept so that it can be
+    updated when files change. The input can be an org file, a directory of
+    them or a file list, same as for the cli.
+    """
+
+    def __init__(self, input_path, cache=None, jobs=1):
+        self.input_path = Path(input_path)
+        self.cache = cache
+        self.jobs = jobs
+        self.targets = None
+        self.files_to_parsers = None
+
+    def find_targets(self):
+        if self.input_path.is_dir():
+            return [p.resolve() for p in list_directory(self.input_path)]
+        if self.input_path.suffix == '.org':
+            return [self.input_path.resolve(),]
+        return [p.resolve() for p in read_filelist(self.input_path)]
+
+    def build(self):
+        self.targets = self.find_targets()
+        self.files_to_parsers = FilesToParsers(self.targets, cache=self.cache, jobs=self.jobs)
+        return self.files_to_parsers.run_parsers()
+
+    def watched_paths(self):
+        """ Returns the files and the directories to watch. A directory is watched for
+        org files coming and going, the files for changes. Includes that were not
+        found are watched too, so that creating one gets it into the document."""
+        ftp = self.files_to_parsers
+        files = set(ftp.parsers_by_path.keys())
+        for included in ftp.includes_by_path.values():
+            if included:
+                files.update(included)
+        for bad_paths in ftp.bad_includes_by_path.values():
+            files.update(bad_paths)
+        directories = set()
+        if self.input_path.is_dir():
+            directories.add(self.input_path.resolve())
+        elif self.input_path.suffix != '.org':
+            files.add(self.input_path.resolve())
+        return files, directories
+
+    def update(self, changed):
+        """ Parses again only the files that changed or that include a changed file,
+        using the parsers' incremental reparse. Anything that changes the set of files,
+        including an edit to the include lines, gets a full build."""
+        targets = self.find_targets()
+        if targets != self.targets:
+            logger.info("input file set changed, parsing everything")
+            return self.build()
+        ftp = self.files_to_parsers
+        ftp.include_resolver.forget(changed)
+        # the prefetched link lookups are from the last build, let the
+        # parsers check the files again
+        clear_prefetch()
+        for path, parser in ftp.parsers_by_path.items():
+            included = ftp.includes_by_path.get(path) or []
+            missing = ftp.bad_includes_by_path.get(path) or []
+            if (path not in changed and not changed.intersection(included)
+                    and not changed.intersection(missing)):
+                continue
+            contents, new_included, bad_paths = ftp.read_with_includes(path)
+            if (new_included or []) != included:
+                logger.info("includes of %s changed, parsing everything", path)
+                return self.build()
+            if bad_paths:
+                ftp.bad_includes_by_path[path] = bad_paths
+            else:
+                ftp.bad_includes_by_path.pop(path, None)
+            res = parser.reparse(contents)
+            logger.info("reparsed %s, %s", path, res)
+        ftp.resolve_links()
+        return ftp.parsers
+
+
+class PollingWatcher:
+    """ Finds changes by comparing the modification time and size of the watched
+    files, and the org file listing of the watched directories, every interval
+    seconds."""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.state = {}
+
+    def set_paths(self, files, directories):
+        # keep the recorded state of paths we already know about so that a
+        # change that lands during a rebuild is still seen on the next wait
+        state = {}
+        for path in list(files) + list(directories):
+            if path in self.state:
+                state[path] = self.state[path]
+            else:
+                state[path] = self.get_state(path)
+        self.state = state
+
+    def get_state(self, path):
+        if path.is_dir():
+            return tuple(p.name for p in list_directory(path))
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def check(self):
+        changed = set()
+        for path, old in self.state.items():
+            new = self.get_state(path)
+            if new != old:
+                self.state[path] = new
+                if path.is_dir() and old is not None and new is not None:
+                    names = set(old).symmetric_difference(new)
+                    changed.update(Path(path, name) for name in names)
+                else:
+                    changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        """ Returns the set of changed paths, empty if timeout seconds go by without
+        a change, or waits forever if timeout is None."""
+        start = time.monotonic()
+        while True:
+            changed = self.check()
+            if changed:
+                return changed
+            if timeout is not None and time.monotonic() - start >= timeout:
+                return changed
+            time.sleep(self.interval)
+
+
+class InotifyWatcher:
+    """ Linux inotify through libc, watching the directories that hold the watched
+    files, since editors often save by writing a new file and renaming it."""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_CLOEXEC = 0o2000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    event_header = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self.files = set()
+        self.directories = set()
+
+    def set_paths(self, files, directories):
+        self.files = set(files)
+        self.directories = set(directories)
+        wanted = set(p.parent for p in self.files) | self.directories
+        for wd, directory in list(self.watches.items()):
+            if directory not in wanted:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+        have = set(self.watches.values())
+        for directory in wanted - have:
+            wd = self.libc.inotify_add_watch(self.fd, str(directory).encode(), self.mask)
+            if wd < 0:
+                logger.warning("cannot watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+                continue
+            self.watches[wd] = directory
+
+    def wait(self, timeout=None):
+        """ Returns the set of changed paths, empty if timeout seconds go by without
+        a change, or waits forever if timeout is None."""
+        start = time.monotonic()
+        while True:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, timeout - (time.monotonic() - start))
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return set()
+            changed = self.read_events(os.read(self.fd, 64 * 1024))
+            if changed:
+                return changed
+
+    def read_events(self, data):
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            directory = self.watches.get(wd)
+            if directory is None or name == "":
+                continue
+            path = Path(directory, name)
+            if path in self.files or (directory in self.directories and path.suffix == '.org'):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+def make_watcher():
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError) as e:
+        logger.info("inotify not available (%s), polling for changes", e)
+        return PollingWatcher()
+
+def run_watch(watched_input, on_rebuild, watcher=None, debounce=0.3):
+    """ Waits for changes to the watched input and calls on_rebuild with the updated
+    parsers after each one. Changes that arrive within debounce seconds of each
+    other are handled together. Runs until interrupted."""
+    if watcher is None:
+        watcher = make_watcher()
+    while True:
+        files, directories = watched_input.watched_paths()
+        watcher.set_paths(files, directories)
+        changed = watcher.wait()
+        # let a burst of saves settle before rebuilding
+        more = watcher.wait(timeout=debounce)
+        while more:
+            changed.update(more)
+            more = watcher.wait(timeout=debounce)
+        logger.info("changed: %s", ", ".join(str(p) for p in sorted(changed)))
+        try:
+            parsers = watched_input.update(changed)
+            on_rebuild(parsers)
+        except Exception as e:
+            # a half written save shouldn't end the session, but the tree
+            # may be part way updated so start fresh on the next change
+            logger.error("rebuild failed: %s", e)
+            watched_input.targets = None
@@ -8,8 +8,17 @@ import pytest
 from unittest.mock import patch
 from roam2doc.parse import (DocParser, MatchHeading, MatchTable, MatchList,
                             MatchQuote, MatchCenter, MatchExample,
-                            ParagraphParse, MatcherType, ToolBox, SectionParse)
-from roam2doc.tree import (OrderedList, OrderedListItem, BlankLine, Section)
+                            ParagraphParse, MatcherType, ToolBox, SectionParse,
+                            LineClasses, LineKind, ListType, InlineTokenizer)
+from roam2doc.tree import (OrderedList, OrderedListItem, BlankLine, Section,
+                           Paragraph, Text, BoldText, ItalicText, InternalLink,
+                           Image, Heading, ChildList,
+                           CodeBlock, TextRun, List, UnorderedList, ListItem,
+                           Container, subtree_nodes)
+from roam2doc.cache import ParseCache
+from roam2doc import images
+from roam2doc.io import parse_fileset, parse_directory, FilesToParsers
+from roam2doc.watch import WatchedInput, PollingWatcher, make_watcher
 from roam2doc.setup_logging import setup_logging
 from roam2doc.cli import main
 
@@ -83,6 +92,172 @@ def test_parser_stack():
     assert len(doc_parser.parse_problems) == 0
 
 
+def test_line_classes():
+    lines = []
+    lines.append('* Section 1 heading')
+    lines.append('')
+    lines.append('#+NAME: table1')
+    lines.append('| a | b |')
+    lines.append('  1. ordered item')
+    lines.append('  - foo :: def item')
+    lines.append('  + unordered item')
+    lines.append('#+begin_src python')
+    lines.append('x = 1')
+    lines.append('#+END_SRC')
+    lines.append(':PROPERTIES:')
+    lines.append('** Sub heading')
+    classes = LineClasses(lines)
+    assert classes.kinds[0] == LineKind.heading
+    assert classes.levels[0] == 1
+    assert classes.levels[11] == 2
+    assert classes.is_blank(1)
+    assert classes.kinds[2] == LineKind.keyword
+    assert classes.element_type(3) == MatcherType.table
+    assert classes.list_type(4) == ListType.ordered_list
+    assert classes.levels[4] == 2
+    assert classes.list_type(5) == ListType.def_list
+    assert classes.list_type(6) == ListType.unordered_list
+    assert classes.element_type(7) == MatcherType.code_block
+    assert classes.kinds[8] == LineKind.text
+    assert classes.kinds[9] == LineKind.block_end
+    assert classes.is_property(10)
+    assert classes.find_element(1, len(lines)) == 3
+    assert classes.find_element(8, 10) is None
+    assert classes.find_block_end(7, len(lines)) == 9
+    assert classes.keywords_before(1, 3) == ['#+NAME: table1']
+    assert classes.keywords_before(3, 3) == []
+
+    doc_parser = DocParser("\n".join(lines), "")
+    elem = ToolBox(doc_parser).get_next_element(1, len(lines))
+    assert elem['match_type'] == MatcherType.table
+    assert elem['keywords'] == ['#+NAME: table1']
+    elem = ToolBox(doc_parser).get_next_element(7, len(lines))
+    assert elem['end_match']['pos'] == 9
+
+def test_block_pairing():
+    lines = []
+    lines.append('#+BEGIN_QUOTE')            # 0
+    lines.append('#+BEGIN_QUOTE')            # 1
+    lines.append('inner quote')              # 2
+    lines.append('#+END_QUOTE')              # 3
+    lines.append('#+END_QUOTE')              # 4
+    lines.append('#+BEGIN_EXAMPLE')          # 5
+    lines.append('#+BEGIN_SRC')              # 6
+    lines.append('#+END_EXAMPLE')            # 7
+    lines.append('#+BEGIN_SRC python')       # 8
+    lines.append('never closed')             # 9
+    lines.append('#+BEGIN_CENTER')           # 10
+    lines.append('centered')                 # 11
+    lines.append('#+END_CENTER')             # 12
+    classes = LineClasses(lines)
+    assert classes.find_block_end(0, len(lines)) == 4
+    assert classes.find_block_end(1, len(lines)) == 3
+    assert classes.find_block_end(5, len(lines)) == 7
+    # src line inside the example block is just text
+    assert classes.block_ends[6] == -1
+    assert classes.find_block_end(8, len(lines)) is None
+    assert classes.find_block_end(10, len(lines)) == 12
+    # pair beyond the search range does not count
+    assert classes.find_block_end(10, 11) is None
+
+    doc_parser = DocParser("\n".join(lines), "")
+    branch = doc_parser.parse()
+    section = branch.children[0]
+    outer = section.children[0]
+    assert outer.end_line == 3
+    assert outer.children[0].__class__.__name__ == "QuoteBlock"
+    example = section.children[1]
+    assert example.text == "#+BEGIN_SRC"
+    # the unclosed src block runs to the end of the section
+    code = section.children[2]
+    assert "#+END_CENTER" in code.text
+
+def test_section_split():
+    lines = []
+    lines.append('Some zeroth section text')   # 0
+    lines.append('* Section 1 heading')        # 1
+    lines.append('#+BEGIN_SRC org')            # 2
+    lines.append('* not a heading, src text')  # 3
+    lines.append('#+END_SRC')                  # 4
+    lines.append('**  Section 2 heading')      # 5
+    lines.append('text')                       # 6
+    doc_parser = DocParser("\n".join(lines), "")
+    spans = doc_parser.line_classes.split_sections(0)
+    assert [tuple(span) for span in spans] == [(0, 0, None, None),
+                                               (1, 4, 1, "Section 1 heading"),
+                                               (5, 6, 2, "Section 2 heading")]
+    branch = doc_parser.parse()
+    assert len(branch.children) == 3
+    code = branch.children[1].children[0]
+    assert code.text == "* not a heading, src text"
+    assert branch.children[2].heading.level == 2
+
+def test_reparse():
+    lines = ["* first", "see [[target one]]", "",
+             "* second", "has <<target one>> in it", "",
+             "* third", "just text", ""]
+    doc_parser = DocParser("\n".join(lines), "reparse.org")
+    doc_parser.parse()
+    first, second, third = doc_parser.branch.children
+    assert "target one" in doc_parser.root.link_targets
+    assert 'href="#obj-' in doc_parser.root.to_html()
+
+    # change the second section only, the others keep their nodes
+    lines[4] = "lost the target"
+    lines.insert(5, "and grew a line")
+    res = doc_parser.reparse("\n".join(lines))
+    assert res == dict(reused=2, removed=1, added=1)
+    kids = doc_parser.branch.children
+    assert kids[0] is first and kids[2] is third
+    assert kids[1] is not second
+    assert "target one" not in doc_parser.root.link_targets
+    assert "not found" in doc_parser.root.to_html()
+    # the third section moved down a line
+    assert third.start_line == 7
+    assert third.heading.start_line == 7
+    assert third.children[0].children[0].get_source_data()["source"] == "just text"
+
+    # putting the target back makes the link resolve again
+    lines[4] = "has <<target one>> in it"
+    res = doc_parser.reparse("\n".join(lines))
+    assert res['added'] == 1
+    assert "not found" not in doc_parser.root.to_html()
+
+def test_inline_tokenizer():
+    tokenizer = InlineTokenizer()
+    assert tokenizer.tokenize("no markup here at all") == []
+    line = "a *b /c/ d* =e= [[target][*f*]] <<g>>, _h_"
+    spans = tokenizer.tokenize(line)
+    types = [span.match_type for span in spans]
+    assert types == [MatcherType.bold_object, MatcherType.verbatim_object,
+                     MatcherType.internal_link_object, MatcherType.target_object,
+                     MatcherType.underlined_object]
+    for span in spans:
+        assert line[span.start] in "*=[<_"
+        assert line[span.end] in "*=]>_"
+    assert line[spans[0].content_start:spans[0].content_end] == "b /c/ d"
+    link = spans[2]
+    assert link.target == "target"
+    assert line[link.content_start:link.content_end] == "*f*"
+
+    lines = ['* Heading', 'x ' + line]
+    doc_parser = DocParser("\n".join(lines), "")
+    branch = doc_parser.parse()
+    para = branch.children[0].children[0]
+    assert isinstance(para, Paragraph)
+    bold = para.children[1]
+    assert isinstance(bold, BoldText)
+    assert bold.simple_text is None
+    assert [type(c) for c in bold.children] == [Text, ItalicText, Text]
+    assert bold.get_source_data()['source'] == "*b /c/ d*"
+    # text after an object keeps its first character
+    comma = para.children[5]
+    assert comma.text == ","
+    assert comma.get_source_data()['source'] == ","
+    link_node = para.children[3]
+    assert isinstance(link_node, InternalLink)
+    assert link_node.children[0].get_source_data()['source'] == "*f*"
+
 def test_latex_1():
     #path, contents =get_example_file_path_and_contents("min.org")
     path, contents =get_example_file_path_and_contents("all_nodes.org")
@@ -341,6 +516,38 @@ def test_file_all_nodes():
     doc_parser.root.to_html()
     doc_parser.root.to_html(include_json=True)
 
+def test_write_html(tmp_path):
+    name = "all_nodes.org"
+    path, contents = get_example_file_path_and_contents(name)
+    doc_parser =  DocParser(contents, path)
+    doc_parser.parse()
+    root = doc_parser.root
+    expected = root.to_html(include_json=True)
+    out_path = Path(tmp_path, "out.html")
+    with open(out_path, 'w', encoding="utf-8") as f:
+        root.write_html(f, include_json=True)
+    with open(out_path, 'r', encoding="utf-8") as f:
+        assert f.read() == expected
+    # the style block is complete even though it goes out ahead of the body
+    assert ".org-auto-Table {" in expected.split("<body>")[0]
+    section = doc_parser.branch.children[0]
+    assert "\n".join(section.to_html(1)) in expected
+
+def test_write_latex(tmp_path):
+    name = "all_nodes.org"
+    path, contents = get_example_file_path_and_contents(name)
+    doc_parser =  DocParser(contents, path)
+    doc_parser.parse()
+    root = doc_parser.root
+    expected = root.to_latex(grokify=True)
+    out_path = Path(tmp_path, "out.tex")
+    with open(out_path, 'w', encoding="utf-8") as f:
+        root.write_latex(f, grokify=True)
+    with open(out_path, 'r', encoding="utf-8") as f:
+        assert f.read() == expected
+    section = doc_parser.branch.children[0]
+    assert "\n".join(section.to_latex()) in expected
+
 def test_file_all_nodes_cli():
     # the purpose of this is not to actually test, it
     # is to use coverage to measure how much code the target file
@@ -433,6 +640,21 @@ def test_cli():
             parsers = main()
         
         
+def test_cli_cache_stats(tmp_path):
+    this_dir = Path(__file__).resolve().parent
+    org_file = Path(this_dir, 'org_files', 'examples', 'objects.org')
+    out_file = Path(tmp_path, "out.html")
+    args = ['tester', str(org_file), '--output', str(out_file), '--overwrite',
+            '--cache-dir', str(Path(tmp_path, "cache")), '--cache-stats']
+    stats = []
+    for run in range(2):
+        with patch('sys.stderr', new=StringIO()) as fake_err:
+            with patch('sys.argv', args):
+                main()
+            stats.append(json.loads(fake_err.getvalue()))
+    assert stats[0] == dict(hits=0, misses=1, evictions=0)
+    assert stats[1] == dict(hits=1, misses=0, evictions=0)
+
 def test_roam_combine_1():
    
     def do_checks(b2):
@@ -457,6 +679,504 @@ def test_roam_combine_1():
         parsers = main()
     do_checks(parsers[1].branch)
             
+def test_parse_cache(tmp_path):
+    this_dir = Path(__file__).resolve().parent
+    target_dir = Path(this_dir, 'org_files', 'roam2')
+    paths = sorted(target_dir.glob('*.org'))
+    fresh = parse_fileset(paths)
+    cache = ParseCache(tmp_path)
+    first = parse_fileset(paths, cache=cache)
+    assert cache.get_stats()['hits'] == 0
+    assert cache.get_stats()['misses'] == len(first)
+    cached = parse_fileset(paths, cache=cache)
+    assert cache.get_stats()['hits'] == len(cached)
+    assert cached[0].root is not first[0].root
+    for parser in cached:
+        assert parser.root is cached[0].root
+    assert cached[0].root.node_id == fresh[0].root.node_id
+    assert cached[0].root.to_html(include_json=True) == fresh[0].root.to_html(include_json=True)
+    assert cached[0].root.to_latex() == fresh[0].root.to_latex()
+
+    # a tiny size limit leaves only the most recently stored entry
+    small = ParseCache(tmp_path, max_bytes=1)
+    parse_fileset(paths[:1], cache=small)
+    assert len(list(tmp_path.glob('*.pickle'))) == 1
+
+def test_parse_cache_linked_image(tmp_path, monkeypatch):
+    # link paths are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    doc = Path(tmp_path, "doc.org")
+    doc.write_text("* pics\n[[pic.png][pic]]\n")
+    cache = ParseCache(Path(tmp_path, "cache"))
+    before = parse_fileset([doc], cache=cache)
+    assert len([n for n in subtree_nodes(before[0].branch) if isinstance(n, InternalLink)]) == 1
+    Path(tmp_path, "pic.png").write_bytes(b'\x89PNG\r\n\x1a\n' + b'\0' * 16)
+    after = parse_fileset([doc], cache=cache)
+    assert cache.get_stats()['hits'] == 0
+    assert len([n for n in subtree_nodes(after[0].branch) if isinstance(n, Image)]) == 1
+    # the cache key takes the link types from the prefetch, not the files
+    lines = doc.read_text().split('\n')
+    images.prefetch_link_files([lines], "doc.org")
+    key = cache.make_key(lines, "doc.org", "doc.org")
+    Path(tmp_path, "pic.png").write_text("not a picture any more")
+    assert cache.make_key(lines, "doc.org", "doc.org") == key
+    images.clear_prefetch()
+    assert cache.make_key(lines, "doc.org", "doc.org") != key
+
+def test_parse_cache_include_origins(tmp_path):
+    cache = ParseCache(Path(tmp_path, "cache"))
+    for name in ("a.txt", "b.txt"):
+        Path(tmp_path, name).write_text("included text\n")
+    main_file = Path(tmp_path, "main.org")
+    keys = []
+    for name in ("a.txt", "b.txt"):
+        main_file.write_text(f"* main\n#+BEGIN_FILE_INCLUDE\n{name}\n#+END_FILE_INCLUDE\n")
+        ftp = FilesToParsers([main_file,])
+        doc, included, bad = ftp.read_with_includes(main_file)
+        keys.append(cache.make_key(doc, "main.org", "main.org"))
+    # the same lines, but the nodes would name a different source file
+    assert keys[0] != keys[1]
+
+def test_parallel_parse(tmp_path):
+    this_dir = Path(__file__).resolve().parent
+    target_dir = Path(this_dir, 'org_files', 'roam1')
+    serial = parse_directory(target_dir)
+    parallel = parse_directory(target_dir, jobs=2)
+    assert [p.source for p in parallel] == [p.source for p in serial]
+    for parser in parallel:
+        assert parser.root is parallel[0].root
+    s_root = serial[0].root
+    p_root = parallel[0].root
+    assert list(p_root.link_targets.keys()) == list(s_root.link_targets.keys())
+    for target_id, link_target in p_root.link_targets.items():
+        assert link_target.target_node.node_id == s_root.link_targets[target_id].target_node.node_id
+    assert p_root.to_html(include_json=True) == s_root.to_html(include_json=True)
+
+    # worker results go into the cache too
+    cache = ParseCache(tmp_path)
+    parse_directory(target_dir, jobs=2, cache=cache)
+    cached = parse_directory(target_dir, jobs=2, cache=cache)
+    assert cache.get_stats()['hits'] == len(cached)
+    assert cached[0].root.to_html(include_json=True) == s_root.to_html(include_json=True)
+
+    # an entry that can't be loaded is parsed again, removed and counted as a miss
+    entries = sorted(tmp_path.glob('*.pickle'))
+    entries[0].write_bytes(b'\0\0\0\0not a pickle')
+    cache = ParseCache(tmp_path)
+    cached = parse_directory(target_dir, jobs=2, cache=cache)
+    assert not entries[0].exists()
+    assert cache.get_stats()['hits'] == len(cached) - 1
+    assert cache.get_stats()['misses'] == 1
+    assert cached[0].root.to_html(include_json=True) == s_root.to_html(include_json=True)
+
+def test_watch(tmp_path):
+    one = Path(tmp_path, "one.org")
+    two = Path(tmp_path, "two.org")
+    inc = Path(tmp_path, "inc.txt")
+    one.write_text("* one\nfirst file\n")
+    two.write_text("* two\n#+BEGIN_FILE_INCLUDE\ninc.txt\n#+END_FILE_INCLUDE\n* two b\nafter\n")
+    inc.write_text("included text\n")
+    watched = WatchedInput(tmp_path)
+    parsers = watched.build()
+    files, directories = watched.watched_paths()
+    assert inc.resolve() in files
+    assert directories == set([tmp_path.resolve()])
+
+    for index, watcher in enumerate((PollingWatcher(interval=0.01), make_watcher())):
+        watcher.set_paths(files, directories)
+        assert watcher.wait(timeout=0.05) == set()
+        # a size change, so polling sees it even if the mtime doesn't move
+        inc.write_text("changed included text" + "!" * index + "\n")
+        changed = watcher.wait(timeout=2)
+        assert inc.resolve() in changed
+
+    # only the including file gets parsed again
+    one_branch = parsers[0].branch
+    two_sections = list(parsers[1].branch.children)
+    updated = watched.update(set([inc.resolve()]))
+    assert updated[0].branch is one_branch
+    assert updated[1].branch.children[0] is not two_sections[0]
+    assert updated[1].branch.children[1] is two_sections[1]
+    assert "changed included text" in updated[0].root.to_html()
+
+    # a new file means a full build
+    Path(tmp_path, "three.org").write_text("* three\n")
+    updated = watched.update(set([Path(tmp_path, "three.org").resolve()]))
+    assert len(updated) == 3
+
+def test_watch_missing_include(tmp_path, monkeypatch):
+    # the include problems report goes in the working directory
+    monkeypatch.chdir(tmp_path)
+    main_file = Path(tmp_path, "main.org")
+    later = Path(tmp_path, "later.txt")
+    main_file.write_text("* main\n#+BEGIN_FILE_INCLUDE\nlater.txt\n#+END_FILE_INCLUDE\n")
+    watched = WatchedInput(main_file)
+    parsers = watched.build()
+    assert "text from later" not in parsers[0].root.to_html()
+    files, directories = watched.watched_paths()
+    assert later.resolve() in files
+
+    watcher = PollingWatcher(interval=0.01)
+    watcher.set_paths(files, directories)
+    later.write_text("text from later\n")
+    assert later.resolve() in watcher.wait(timeout=2)
+    updated = watched.update(set([later.resolve()]))
+    assert "text from later" in updated[0].root.to_html()
+    assert watched.files_to_parsers.bad_includes_by_path == {}
+
+def test_include_resolver(tmp_path, monkeypatch):
+    # the include problems report goes in the working directory
+    monkeypatch.chdir(tmp_path)
+    sub = Path(tmp_path, "sub")
+    sub.mkdir()
+    main_file = Path(tmp_path, "main.org")
+    other = Path(tmp_path, "other.org")
+    shared = Path(sub, "shared.txt")
+    nested = Path(sub, "nested.txt")
+    loop = Path(tmp_path, "loop.org")
+    main_file.write_text("* main\n#+BEGIN_FILE_INCLUDE\nsub/shared.txt ** Shared\n\nloop.org\n#+END_FILE_INCLUDE\n")
+    other.write_text("* other\n#+BEGIN_FILE_INCLUDE\nsub/shared.txt\n#+END_FILE_INCLUDE\n")
+    # relative to the including file, and not shifted by the outer include's heading
+    shared.write_text("* shared heading\n#+BEGIN_FILE_INCLUDE\nnested.txt\n#+END_FILE_INCLUDE\n")
+    nested.write_text("* nested heading\n")
+    loop.write_text("* loop\n#+BEGIN_FILE_INCLUDE\nmain.org\n#+END_FILE_INCLUDE\n")
+
+    ftp = FilesToParsers([main_file, other])
+    resolver = ftp.include_resolver
+    reads = []
+    real_read = resolver.read_lines
+    def counting_read(path):
+        if path not in resolver.lines_by_path:
+            reads.append(path)
+        return real_read(path)
+    resolver.read_lines = counting_read
+    parsers = ftp.run_parsers()
+    assert len(parsers) == 2
+    assert len(reads) == len(set(reads))
+    assert shared.resolve() in reads and nested.resolve() in reads
+
+    lines, included, bad = resolver.expand(main_file)
+    assert lines[:4] == ["* main", "** Shared", "*** shared heading", "* nested heading"]
+    assert included == [shared.resolve(), nested.resolve(), loop.resolve()]
+    # a cycle is not a missing file
+    assert bad is None
+    assert resolver.cycles[0] == [main_file.resolve(), loop.resolve(), main_file.resolve()]
+    report = Path(tmp_path, "bad_includes.list").read_text()
+    assert report.startswith(f"cycles_from {main_file.resolve()}\n")
+    assert f"{main_file.resolve()} -> {loop.resolve()} -> {main_file.resolve()}" in report
+
+def test_included_source_data(tmp_path):
+    main_file = Path(tmp_path, "main.org")
+    inc = Path(tmp_path, "inc.org")
+    main_file.write_text("* main\nmain text\n#+BEGIN_FILE_INCLUDE\ninc.org ** From include\n#+END_FILE_INCLUDE\nafter text\n")
+    inc.write_text("first included\n* inc heading\n\nsecond included\n")
+    ftp = FilesToParsers([main_file,])
+    doc, included, bad = ftp.read_with_includes(main_file)
+    assert list(doc) == ["* main", "main text", "** From include", "first included",
+                         "*** inc heading", "", "second included", "", "after text", ""]
+    assert doc[4] == "*** inc heading"
+    assert doc[2:5] == ["** From include", "first included", "*** inc heading"]
+    assert doc.origin(2) == (main_file.resolve(), 3)
+    assert doc.origin(6) == (inc.resolve(), 3)
+    assert doc.origin(8) == (main_file.resolve(), 5)
+
+    parser = ftp.run_parsers()[0]
+    texts = {}
+    for node in subtree_nodes(parser.branch):
+        if isinstance(node, Text):
+            texts[node.text.strip()] = node.get_source_data()
+    assert texts["second included"]['source_file'] == str(inc.resolve())
+    assert texts["second included"]['source_line'] == 3
+    assert texts["after text"]['source_file'] == str(main_file.resolve())
+    assert texts["after text"]['source_line'] == 5
+    assert texts["after text"]['source'] == "after text"
+
+def test_image_detection(tmp_path, monkeypatch):
+    samples = {"a.png": b'\x89PNG\r\n\x1a\n' + bytes(20),
+               "b.jpg": b'\xff\xd8\xff\xe0' + bytes(20),
+               "c.gif": b'GIF89a' + bytes(20),
+               "d.webp": b'RIFF\x10\x00\x00\x00WEBPVP8 ',
+               "e.svg": b'<?xml version="1.0"?>\n<!-- x -->\n<svg xmlns="http://www.w3.org/2000/svg"></svg>',
+               "f.pdf": b'%PDF-1.4\n',
+               "g.txt": b'just some text\n'}
+    expected = ['png', 'jpeg', 'gif', 'webp', 'svg', 'pdf', None]
+    for (name, data), file_type in zip(samples.items(), expected):
+        Path(tmp_path, name).write_bytes(data)
+        assert images.detect_file_type(Path(tmp_path, name)) == file_type
+    assert images.detect_file_type(Path(tmp_path, "missing.png")) is None
+    assert images.detect_file_type(tmp_path) is None
+
+    # remembered until the file changes
+    target = Path(tmp_path, "g.txt")
+    with patch('builtins.open', side_effect=AssertionError("read again")):
+        assert images.detect_file_type(target) is None
+    target.write_bytes(b'GIF87a, now longer than it was')
+    assert images.is_image_file(target)
+
+    # link paths are relative to the directory of the root source, which is
+    # just the file name
+    monkeypatch.chdir(tmp_path)
+    doc = Path(tmp_path, "doc.org")
+    doc.write_text("* links\n[[file:./a.png][png]] [[f.pdf][pdf]] [[g.txt][gif]]\n")
+    parser = parse_fileset([doc,])[0]
+    kinds = [node.__class__.__name__ for node in subtree_nodes(parser.branch)
+             if isinstance(node, (Image, InternalLink))]
+    assert kinds == ["Image", "InternalLink", "Image"]
+
+    # after a prefetch the parser looks the answers up without touching the files
+    found = images.prefetch_link_files([doc.read_text(),], doc.name)
+    assert found[Path("a.png")] == 'png' and found[Path("f.pdf")] == 'pdf'
+    with patch('roam2doc.images.detect_file_type', side_effect=AssertionError("not prefetched")):
+        parser = DocParser(doc.read_text(), doc.name)
+        parser.parse()
+    kinds = [node.__class__.__name__ for node in subtree_nodes(parser.branch)
+             if isinstance(node, (Image, InternalLink))]
+    assert kinds == ["Image", "InternalLink", "Image"]
+    images.clear_prefetch()
+
+def test_heading_index():
+    text = "* A\n** Dup\n* B\n** C\n*** Dup\n* Dup\n* Spaced   Out\n"
+    parser = DocParser(text, "dup.org")
+    parser.parse()
+    root = parser.root
+    top_dup = [sec.heading for sec in parser.branch.children if sec.heading.original_text == "Dup"][0]
+    # sections at a level are checked before going down into them
+    assert root.find_heading_match("Dup") is top_dup
+    assert root.search_heading_match("Dup", root.trunk) is top_dup
+    ambiguities = root.find_heading_ambiguities()
+    assert list(ambiguities.keys()) == ["Dup"]
+    assert ambiguities["Dup"][0] is top_dup and len(ambiguities["Dup"]) == 3
+    assert root.find_heading_match("spaced out") is None
+    assert root.find_heading_match("spaced out", normalized=True).original_text == "Spaced   Out"
+
+    # the index agrees with searching the tree
+    this_dir = Path(__file__).resolve().parent
+    parsers = parse_directory(Path(this_dir, 'org_files', 'roam1'))
+    root = parsers[0].root
+    for node in subtree_nodes(root.trunk):
+        if isinstance(node, Heading):
+            expected = root.search_heading_match(node.original_text, root.trunk)
+            assert root.find_heading_match(node.original_text) is expected
+
+    # a reparse drops the removed headings
+    parser.reparse("* A\n** Dup\n* B\n")
+    assert len(parser.root.headings_by_text["Dup"]) == 1
+    assert parser.root.find_heading_match("Spaced   Out") is None
+
+def test_link_graph():
+    text = ("* Target\n<<here>> is a target\n* Links\n"
+            "[[here]] and [[Target]] and [[here][again]] and [[nowhere]]\n")
+    parser = DocParser(text, "links.org")
+    parser.parse()
+    root = parser.root
+    graph = root.resolve_links()
+    links = [node for node in subtree_nodes(parser.branch) if isinstance(node, InternalLink)]
+    links.sort(key=lambda node: node.node_id)
+    assert [link.target_text for link in links] == ["here", "Target", "here", "nowhere"]
+    here_node = root.link_targets["here"].target_node
+    assert graph.get_target(links[0]) is here_node
+    assert graph.get_links_to(here_node) == [links[0], links[2]]
+    assert graph.get_links_to(root.link_targets["Target"].target_node) == [links[1]]
+    assert graph.broken == [links[3]]
+    assert root.link_targets["here"].references == [links[0], links[2]]
+    report = root.get_broken_link_report()
+    assert len(report) == 1
+    assert report[0]['target_text'] == "nowhere" and report[0]['source_line'] == 3
+
+    # rendering reads the results rather than resolving again
+    with patch.object(root, 'resolve_links', side_effect=AssertionError("resolved again")):
+        root.to_html()
+        root.to_latex(grokify=True)
+    assert root.link_targets["here"].references == [links[0], links[2]]
+
+    # changing the tree means resolving again
+    parser.reparse(text + "[[Links]]\n")
+    assert root.link_graph is None
+    assert len(root.get_link_graph().target_by_link) == 5
+
+def test_node_root_and_branch():
+    this_dir = Path(__file__).resolve().parent
+    parsers = parse_directory(Path(this_dir, 'org_files', 'roam1'))
+    for parser in parsers:
+        # the trunk branch holds the other branches as well as its sections
+        for section in parser.branch.children:
+            if isinstance(section, Section):
+                for node in subtree_nodes(section):
+                    assert node.root is parser.root
+                    assert node.branch is parser.branch
+
+    # moving a subtree to another branch moves all of it
+    first, second = parsers[0], parsers[1]
+    section = first.branch.children[0]
+    first.branch.children.remove(section)
+    section.move_to_parent(second.branch)
+    assert section in second.branch.children
+    for node in subtree_nodes(section):
+        assert node.branch is second.branch
+
+def test_grokify_targets():
+    text = ("* Target\n<<here>> is a target\n\n#+NAME: table1\n| a | b |\n"
+            "* Links\n[[here]] and [[table1]] and [[Target]]\n")
+    parser = DocParser(text, "grok.org")
+    parser.parse()
+    root = parser.root
+    latex = root.to_latex(grokify=True)
+    target_ids = root.get_grok_target_ids()
+    assert target_ids == set(lt.target_node.node_id for lt in root.link_targets.values())
+    for link_target in root.link_targets.values():
+        node = link_target.target_node
+        assert node.get_grok_tag() == f"(xref-id:{node.node_id})"
+    assert [rec['target'] for rec in root.xref_records] == [lt.target_node for lt in root.link_targets.values()]
+    # worked out once, not for each node rendered
+    with patch.object(root, 'prepare_grokify', side_effect=AssertionError("prepared again")):
+        for node in subtree_nodes(parser.branch)[1:]:
+            node.get_grok_tag()
+        assert "\n".join(root.generate_cross_reference()) in latex
+
+def test_child_list():
+    # a few children are just a list, lots of them are indexed as well
+    for extra in (0, ChildList.index_threshold):
+        others = [object() for i in range(extra)]
+        a, b, c, d = object(), object(), object(), object()
+        kids = ChildList(others + [a, b, c])
+        assert list(kids) == others + [a, b, c] and len(kids) == extra + 3
+        assert b in kids and d not in kids
+        assert kids.index(c) == extra + 2 and kids[-1] is c
+        kids.remove(b)
+        assert list(kids) == others + [a, c] and kids.index(c) == extra + 1
+        kids.append(d)
+        assert kids.index(d) == extra + 2 and kids[extra + 1:] == [c, d]
+        with pytest.raises(ValueError):
+            kids.append(a)
+        with pytest.raises(ValueError):
+            kids.remove(b)
+        with pytest.raises(ValueError):
+            kids.index(b)
+        kids[extra:extra + 2] = [b]
+        assert kids == others + [b, d] and a not in kids and kids.pop(extra) is b
+        assert list(reversed(kids))[0] is d
+
+    # table cell contents are made in the table and moved to the cells
+    rows = ["| *a* b | c /d/ |" for i in range(50)]
+    parser = DocParser("* t\n" + "\n".join(rows) + "\n", "table.org")
+    parser.parse()
+    table = parser.branch.children[0].children[0]
+    assert len(table.children) == 50
+    for row in table.children:
+        assert row.children.index(row.children[1]) == 1
+        assert [len(cell.children) for cell in row.children] == [2, 2]
+
+def test_compact_nodes():
+    parser = DocParser("* heading\n<<target>> text\n\n- item\n", "compact.org")
+    parser.parse()
+    for node in subtree_nodes(parser.branch)[1:]:
+        assert not hasattr(node, '__dict__')
+    target = parser.root.link_targets["target"].target_node
+    assert [lt.target_text for lt in target.link_targets] == ["target"]
+    heading = parser.branch.children[0].heading
+    assert heading.link_targets == () and heading.properties == {}
+
+def test_text_spans():
+    text = "* heading\nsome *bold* text\n\n#+begin_src\n  ,* not a heading\n  code\n#+end_src\n"
+    parser = DocParser(text, "spans.org")
+    parser.parse()
+    nodes = sorted(subtree_nodes(parser.branch)[1:], key=lambda n: n.node_id)
+    texts = [n for n in nodes if type(n) == Text]
+    assert [n.text for n in texts] == ["heading", "some", "text"]
+    # read from the lines rather than kept
+    assert all(n._text is None for n in texts)
+    bold = [n for n in nodes if isinstance(n, BoldText)][0]
+    assert bold.simple_text == "bold" and bold._simple_text is True
+    code = [n for n in nodes if isinstance(n, CodeBlock)][0]
+    assert code.text == "* not a heading\ncode" and code._text is None
+    # a text that isn't in the source is kept as given
+    code.text = "replaced"
+    assert code.text == "replaced"
+    # reused sections read the new lines at their new line numbers
+    parser.reparse("* first\n\n" + text)
+    nodes = sorted(subtree_nodes(parser.branch)[1:], key=lambda n: (n.start_line, getattr(n, 'start_pos', 0) or 0))
+    texts = [n for n in nodes if type(n) == Text]
+    assert [n.text for n in texts] == ["first", "heading", "some", "text"]
+
+def test_coalesce():
+    text = "* heading\nfirst line\nsecond *bold* line\nthird line\nfourth line\n\n\n\nnext para\n"
+    parser = DocParser(text, "coalesce.org")
+    parser.parse()
+    root = parser.root
+    latex = root.to_latex()
+    before = len(subtree_nodes(parser.branch))
+    assert root.coalesce() == 4
+    assert len(subtree_nodes(parser.branch)) == before - 4
+    assert root.to_latex() == latex
+    para = parser.branch.children[0].children[0]
+    assert [type(n) for n in para.children] == [TextRun, BoldText, TextRun, BlankLine]
+    run = para.children[2]
+    assert run.text == "line\nthird line\nfourth line" and run._text is None
+    assert (run.start_line, run.end_line) == (2, 4)
+    assert run.line_spans == [(14, 17), (0, 9), (0, 10)]
+    assert (para.children[3].start_line, para.children[3].count) == (5, 2)
+    # nothing left to merge the second time
+    assert root.coalesce() == 0
+
+def test_node_indexes_and_walk():
+    text = "* one\n** two\nsee [[three]]\n\n\n* three\n- a\n  - b\n    - c\n"
+    parser = DocParser(text, "walk.org")
+    parser.parse()
+    root = parser.root
+
+    def check_index():
+        nodes = list(root.walk())
+        assert sorted(root.nodes_by_id) == sorted(n.node_id for n in nodes)
+        assert all(root.get_node(n.node_id) is n for n in nodes)
+        if root.nodes_by_class is not None:
+            assert root.get_nodes(object) == sorted(nodes, key=lambda n: n.node_id)
+
+    check_index()
+    # the class index waits for the first get_nodes
+    assert root.nodes_by_class is None
+    assert [h.original_text for h in root.get_nodes(Heading)] == ["one", "two", "three"]
+    assert [type(n) for n in root.get_nodes(List)] == [UnorderedList] * 3
+    assert root.get_nodes(InternalLink) == list(root.walk(InternalLink))
+    # walk is in document order, pruning skips what is under a node
+    assert [h.original_text for h in root.walk(Heading)] == ["one", "two", "three"]
+    no_lists = list(root.walk(prune=lambda n: isinstance(n, List)))
+    assert len([n for n in no_lists if isinstance(n, List)]) == 1
+    assert not any(isinstance(n, ListItem) for n in no_lists)
+    parser.reparse(text.replace("- c", "- d"))
+    check_index()
+    root.coalesce()
+    check_index()
+    # nested deeper than the recursion limit
+    depth = sys.getrecursionlimit() + 50
+    node = parser.branch.children[-1]
+    for i in range(depth):
+        node = Container(node, 0, 0)
+    assert len(list(root.walk(Container, prune=lambda n: isinstance(n, ListItem)))) >= depth
+    parser.branch.note_parse_done()
+    assert parser.branch.last_node_id == root.node_id
+
+def test_outline():
+    text = "intro\n* a\n*** b\n** c\n- one\n\n\n- two\n* d\n** e\n"
+    parser = DocParser(text, "outline.org")
+    parser.parse()
+    branch = parser.branch
+    # the text before the first heading gets a level 1 section of its own
+    intro, a, b, c, d, e = branch.children
+    expected = [(intro, None, 0, 1), (a, None, 0, 2), (b, a, 1, 1), (c, a, 1, 2),
+                (d, None, 0, 3), (e, d, 1, 1)]
+    for section, parent, depth, ordinal in expected:
+        record = branch.get_outline(section)
+        assert (record['parent'], record['depth'], record['ordinal']) == (parent, depth, ordinal)
+        assert branch.get_parent_section(section) is parent
+    assert branch.get_outline(a)['children'] == [b, c]
+    second_list = c.children[1]
+    assert second_list.get_latex_label_text().endswith("list number 2")
+    assert branch.get_parent_section(second_list.children[0]) is c
+    # a reparse makes it again
+    parser.reparse(text.replace("*** b", "** b"))
+    assert [s.heading.original_text for s in branch.get_outline(a)['children']] == ["b", "c"]
+    assert branch.get_outline(branch.children[3])['ordinal'] == 2
+
 def test_roam_combine_2():
    
     def do_checks(b2):